@@ -1,7 +1,7 @@
 import json
 import os
 
-from flask import Flask, render_template, request, redirect, url_for, session
+from flask import Flask, render_template, request, redirect, url_for, session, g
 
 from .auths.authorize_azure import azure_auth
 from .auths.authorize_youtube import youtube_auth
@@ -17,8 +17,18 @@ from .music.services import MUSIC_SERVICES
 app = Flask(__name__)
 app.secret_key = 'your_secret_key'
 
-neon = Neon()
-neon.connect()
+def get_neon():
+    # each request checks out its own pooled connection on first use
+    if 'neon' not in g:
+        g.neon = Neon()
+        g.neon.open_session()
+    return g.neon
+
+@app.teardown_appcontext
+def close_neon(exception=None):
+    neon = g.pop('neon', None)
+    if neon is not None:
+        neon.close_session()
 
 def load_users():
     return read_json(PROFILES_FOLDER, 'users')
@@ -148,7 +158,7 @@ def rank_albums():
     match request.method:
         case 'GET':
             # Get two random albums with the same category
-            albums_df = neon.get_album_comparisons(1)
+            albums_df = get_neon().get_album_comparisons(1)
             album_1 = albums_df.iloc[0]
             album_2 = albums_df.iloc[1]
             category = albums_df.loc[:, 'category'].iloc[0]
@@ -163,7 +173,7 @@ def rank_albums():
         
 # # @app.route('/top_albums')
 # # def top_albums():
-# #     albums_df = neon.get_user_albums(1)
+# #     albums_df = get_neon().get_user_albums(1)
 # #     return render_template('top_albums.html')
     
     
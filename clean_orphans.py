@@ -0,0 +1,16 @@
+''' Remove rows nothing points to anymore '''
+
+import sys
+
+from .setup import set_up_database
+
+def main():
+    neon = set_up_database()
+
+    stats_df = neon.remove_orphans(dry_run='--dry-run' in sys.argv)
+    print(stats_df)
+
+    neon.refresh_views()
+
+if __name__ == '__main__':
+    main()
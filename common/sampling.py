@@ -0,0 +1,40 @@
+''' Fast weighted draws '''
+
+import random
+
+class AliasTable:
+    def __init__(self, weights, rng=None):
+        # Vose's alias method: O(n) to build, O(1) for every draw after that
+        self.rng = rng or random
+        self.size = len(weights)
+        self.probabilities = [0.0] * self.size
+        self.aliases = [0] * self.size
+
+        total = sum(weights)
+        if (self.size == 0) or (total <= 0):
+            self.size = 0
+            return
+
+        scaled = [w * self.size / total for w in weights]
+        small = [i for i, p in enumerate(scaled) if p < 1]
+        large = [i for i, p in enumerate(scaled) if p >= 1]
+        while small and large:
+            s = small.pop()
+            l = large.pop()
+            self.probabilities[s] = scaled[s]
+            self.aliases[s] = l
+            scaled[l] = scaled[l] + scaled[s] - 1
+            (small if scaled[l] < 1 else large).append(l)
+
+        # whatever is left is 1 up to rounding
+        for i in small + large:
+            self.probabilities[i] = 1.0
+
+    def draw(self):
+        if not self.size:
+            return None
+        i = self.rng.randrange(self.size)
+        return i if self.rng.random() < self.probabilities[i] else self.aliases[i]
+
+    def draws(self, n):
+        return [self.draw() for _ in range(n)]
@@ -28,11 +28,14 @@ _auths_folder = 'auths'
 _tokens_folder = f'{_auths_folder}/tokens'
 _config_folder = 'config'
 _csvs_folder = 'csvs'
+_replica_folder = 'replica'
 
 _config = read_yaml(_config_folder, 'config')
 _api = read_yaml(_config_folder, 'api')
+_database = read_yaml(_config_folder, 'database')
     
 PROFILES_FOLDER = f'{_auths_folder}/app'
+REPLICA_FOLDER = _replica_folder
 
 # LOCATIONS:
 GITHUB_URL = _api['github']['urls']['env']
@@ -96,6 +99,14 @@ SONOS_PORT = _config['sonos']['port']
 NEON_DB_NAME = _config['neon']['db_name']
 NEON_USERNAME = _config['neon']['username']
 NEON_HOST = _config['neon']['host']
+NEON_CHUNK_ROWS = _config['neon']['chunk_rows']
+NEON_POOL_SIZE = _config['neon']['pool_size']
+NEON_MAX_OVERFLOW = _config['neon']['max_overflow']
+NEON_POOL_RECYCLE = _config['neon']['pool_recycle']
+NEON_QUEUE_LEASE = _config['neon']['queue_lease']
+NEON_QUEUE_MAX_FAILURES = _config['neon']['queue_max_failures']
+NEON_SUMMARY_RANKS = _config['neon']['summary_ranks']
+NEON_KEYWORDS = {**_database['keywords'], **_database['music_values'], **_database['critics']}
 
 AZURE_REDIRECT_URI = _config['azure']['redirect_uri']
 AZURE_SCOPE = _config['azure']['scope']
@@ -2,79 +2,165 @@
 
 from datetime import datetime, date as dtdate
 import json
+import csv
+from io import StringIO
 import time
 from collections import Counter
+from contextlib import contextmanager
+from threading import Lock, local
+from os import getpid
+from socket import gethostname
 import re
 
-from pandas import read_sql, isna
+from pandas import DataFrame, read_sql, isna, to_datetime
 from numpy import integer, floating
 from sqlalchemy import create_engine, text
 
 from ..common.secret import get_secret
-from ..common.structure import NEON_DB_NAME, NEON_USERNAME, NEON_HOST
+from ..common.structure import NEON_DB_NAME, NEON_USERNAME, NEON_HOST, NEON_CHUNK_ROWS, \
+     NEON_POOL_SIZE, NEON_MAX_OVERFLOW, NEON_POOL_RECYCLE, NEON_QUEUE_LEASE, NEON_QUEUE_MAX_FAILURES, NEON_KEYWORDS, \
+     NEON_SUMMARY_RANKS
 from .sqls import SQLer
+from .ratings import Elo, Pairer
 
 class Neon:
-    reset_time = 120
+    engine = None
+    engine_pid = None
+    engine_lock = Lock()
+    copy_rows = 1000
+    delta_rows = 500
+    orphan_rows = 1000
+    orphan_lock_timeout = 5
+    chunk_rows = NEON_CHUNK_ROWS
     good_release_types = ['studio', 'compilation', 'soundtrack', 'score']
     medium_release_types = ['ep', 'playlist']
     bad_release_types = ['single']
 
     def __init__(self):
-        self.connection = None
-        self.stopwatch = 0
-    
+        # connections pinned to a thread for multi-statement work
+        self.pinned = local()
+
     def connect(self):
-        self.mark_time()
-        username = NEON_USERNAME
-        password = get_secret('NEON_PASSWORD')
-        host = NEON_HOST
-        db_name = NEON_DB_NAME
-        url = f'postgresql://{username}:{password}.{host}/{db_name}?sslmode=require'
-        
-        print('connecting to database')
-        engine = create_engine(url, pool_pre_ping=True,
-                               connect_args={'keepalives': 1,
-                                             'keepalives_idle': 30,
-                                             'keepalives_interval': 10,
-                                             'keepalives_count': 5})
-        self.connection = engine.connect()
-        print('connected')
+        self.get_engine()
+
+    def get_engine(self):
+        # one engine and pool per process, shared by every Neon
+        with Neon.engine_lock:
+            if (Neon.engine is not None) and (Neon.engine_pid != getpid()):
+                # forked worker: leave the parent's sockets alone and build a fresh pool
+                Neon.engine.dispose(close=False)
+                Neon.engine = None
+
+            if Neon.engine is None:
+                username = NEON_USERNAME
+                password = get_secret('NEON_PASSWORD')
+                host = NEON_HOST
+                db_name = NEON_DB_NAME
+                url = f'postgresql://{username}:{password}.{host}/{db_name}?sslmode=require'
+
+                print('connecting to database')
+                Neon.engine = create_engine(url, pool_size=NEON_POOL_SIZE, max_overflow=NEON_MAX_OVERFLOW,
+                                            pool_recycle=NEON_POOL_RECYCLE, pool_pre_ping=True, pool_use_lifo=True,
+                                            connect_args={'keepalives': 1,
+                                                          'keepalives_idle': 30,
+                                                          'keepalives_interval': 10,
+                                                          'keepalives_count': 5})
+                Neon.engine_pid = getpid()
+                print('connected')
+        return Neon.engine
 
     def disconnect(self):
-        if self.connection:
-            self.connection = None
-            #self.connection.close()
+        self.close_session()
+
+    def dispose(self):
+        with Neon.engine_lock:
+            if Neon.engine is not None:
+                Neon.engine.dispose()
+                Neon.engine = None
 
-    def reconnect(self):
-        if time.time() - self.stopwatch >= self.reset_time:
-            self.disconnect()
-            self.connect()
-        self.mark_time()
+    def get_pool_status(self):
+        pool = self.get_engine().pool
+        pool_status = {'pool_size': pool.size(),
+                       'checked_in': pool.checkedin(),
+                       'checked_out': pool.checkedout(),
+                       'overflow': pool.overflow(),
+                       }
+        return pool_status
 
-    def mark_time(self):
-        self.stopwatch = time.time()
+    ''' connection checkout '''
+    def get_pinned(self):
+        return getattr(self.pinned, 'connection', None)
+
+    def open_session(self):
+        # keep one pooled connection for this thread until the session is closed
+        if self.get_pinned() is None:
+            self.pinned.connection = self.get_engine().connect()
+
+    def close_session(self):
+        connection = self.get_pinned()
+        if connection is not None:
+            self.pinned.connection = None
+            connection.close()
+
+    @contextmanager
+    def session(self):
+        if self.get_pinned() is not None:
+            yield self.get_pinned()
+        else:
+            self.open_session()
+            try:
+                yield self.get_pinned()
+            finally:
+                self.close_session()
+
+    @contextmanager
+    def checkout(self):
+        if self.get_pinned() is not None:
+            yield self.get_pinned()
+        else:
+            with self.get_engine().connect() as connection:
+                yield connection
 
     ''' basic DB functions '''
     def strip(self, sql):
         return re.sub(r'\s+', ' ', sql).strip()
 
     def execute(self, sql=None, commit=True):
-        self.reconnect()
+        rowcount = 0
+        with self.checkout() as connection:
+            for s in (sql if isinstance(sql, list) else [sql]):
+                if isinstance(s, str):
+                    result = connection.execute(text(self.strip(s)))
+                    rowcount += max(result.rowcount, 0)
 
-        if isinstance(sql, list):
-            for s in sql:
-                self.execute(s, commit=False)
-        elif isinstance(sql, str):
-            self.connection.execute(text(self.strip(sql)))
+            if commit:
+                connection.commit()
+
+        return rowcount
+
+    def rollback(self):
+        connection = self.get_pinned()
+        if connection is not None:
+            connection.rollback()
 
-        if commit:
-            self.connection.commit()
-            
     def read_sql(self, sql):
-        self.reconnect()
-        return read_sql(self.strip(sql), self.connection)
- 
+        with self.checkout() as connection:
+            return read_sql(self.strip(sql), connection)
+
+    def copy_rows_in(self, df, table_name):
+        # write the frame as CSV and stream it through COPY on the open transaction
+        buffer = StringIO()
+        writer = csv.writer(buffer)
+        for r in df.values:
+            writer.writerow([self.csvify(v) for v in r])
+        buffer.seek(0)
+
+        columns = ', '.join(df.columns)
+        with self.checkout() as connection:
+            cursor = connection.connection.cursor()
+            cursor.copy_expert(f"COPY {table_name} ({columns}) FROM STDIN WITH (FORMAT csv, NULL '\\N')", buffer)
+            cursor.close()
+
 
     ''' string functions '''
     def dbify(self, value):
@@ -92,6 +178,22 @@ class Neon:
 
         return str(value)
 
+    def csvify(self, value):
+        if isinstance(value, (datetime, dtdate)):
+            value = value.strftime('%Y-%m-%d')
+
+        elif isinstance(value, (list, dict)):
+            value = json.dumps(self.jsonify(value))
+
+        elif (value is None) or isna(value):
+            value = '\\N'
+
+        elif isinstance(value, (float, floating)) and float(value).is_integer():
+            # integer columns with gaps arrive as floats, and COPY won't cast 1999.0 like VALUES does
+            value = int(value)
+
+        return value
+
     def jsonify(self, value):
         if isinstance(value, integer):
             value = int(value)
@@ -114,32 +216,237 @@ class Neon:
     ''' table and view setup '''
     def create_tables(self):
         print('\tcreating tables')
+        self.migrate_album_categories()
         self.execute(SQLer.create_tables())
+        self.migrate_view_deltas()
+        # the orphan views used to be misspelled
+        self.execute('DROP VIEW IF EXISTS _ophan_barcodes, _ophan_recordings, _ophan_works;')
+        # backfill derived tables that may be new
+        self.update_album_tracks()
+        self.migrate_battles()
+        self.migrate_match_keys()
+        # the matches read album_artists, on a new database deploy_views fills them once the view exists
+        if self.read_sql("SELECT to_regclass('album_artists') IS NOT NULL AS deployed;")['deployed'].iloc[0]:
+            self.update_critic_matches()
+        self.update_track_titles()
+        self.update_album_categories()
+        self.recount_queues()
+        if self.read_sql('SELECT NOT EXISTS (SELECT 1 FROM album_ratings) AND EXISTS (SELECT 1 FROM battles) AS unrated;')['unrated'].iloc[0]:
+            self.rebuild_album_ratings()
             
+    def migrate_album_categories(self):
+        # album_categories used to be a view, clear it and its record so deploy_views rebuilds what read it
+        # this runs before the tables are created, so older databases may not have _schema_objects yet
+        sql = (f'''
+               DO $$ BEGIN 
+               IF EXISTS (SELECT 1 FROM pg_views WHERE viewname = 'album_categories') 
+               THEN DROP VIEW album_categories CASCADE; 
+               IF to_regclass('_schema_objects') IS NOT NULL 
+               THEN DELETE FROM _schema_objects WHERE object_name = 'album_categories'; END IF; END IF; 
+               END $$;
+               ''')
+        self.execute(sql)
+
+    def migrate_view_deltas(self):
+        # written tables are noted with the deltas, older databases need the column
+        obj = next(obj for obj in SQLer.get_objects() if obj['name'] == '_view_deltas')
+        self.execute(['ALTER TABLE _view_deltas ADD COLUMN IF NOT EXISTS table_name varchar;'] + SQLer.record_fingerprints([obj]))
+
+    def migrate_battles(self):
+        # move results kept as wins and losses arrays on ownerships into battles
+        sql = (f'''
+               SELECT EXISTS (SELECT 1 FROM information_schema.columns 
+               WHERE table_name = 'ownerships' AND column_name = 'wins') AS legacy 
+               ;
+               ''')
+        if not self.read_sql(sql)['legacy'].iloc[0]:
+            return
+
+        print('\tmigrating battles')
+        sqls = [(f'''
+                 WITH results AS 
+                 (SELECT user_id, source_id AS winner_source_id, album_uri AS winner_uri, 
+                 (opponent->>0)::integer AS loser_source_id, opponent->>1 AS loser_uri 
+                 FROM ownerships, jsonb_array_elements(wins) AS w (opponent) 
+                 UNION SELECT user_id, (opponent->>0)::integer, opponent->>1, source_id, album_uri 
+                 FROM ownerships, jsonb_array_elements(losses::jsonb) AS l (opponent)) 
+                 
+                 INSERT INTO battles (user_id, winner_source_id, winner_uri, loser_source_id, loser_uri) 
+                 SELECT user_id, winner_source_id, winner_uri, loser_source_id, loser_uri FROM results AS r 
+                 WHERE EXISTS (SELECT 1 FROM ownerships AS o WHERE (o.user_id, o.source_id, o.album_uri) = 
+                 (r.user_id, r.loser_source_id, r.loser_uri)) 
+                 AND NOT EXISTS (SELECT 1 FROM results AS x WHERE (x.user_id, x.winner_source_id, x.winner_uri, x.loser_source_id, x.loser_uri) = 
+                 (r.user_id, r.loser_source_id, r.loser_uri, r.winner_source_id, r.winner_uri) 
+                 AND (r.winner_source_id, r.winner_uri) > (r.loser_source_id, r.loser_uri)) 
+                 ON CONFLICT DO NOTHING 
+                 ;
+                 '''),
+                # the old views still read the columns, drop them and forget them so deploy_views builds them again
+                'ALTER TABLE ownerships DROP COLUMN wins CASCADE, DROP COLUMN losses CASCADE;',
+                (f'''
+                 DELETE FROM _schema_objects WHERE object_kind = 'view' 
+                 AND object_name IN ({", ".join(f"'{name}'" for name in SQLer.get_dependents(['ownerships']))}) 
+                 ;
+                 '''),
+                ]
+        self.execute(sqls)
+
+    def migrate_match_keys(self):
+        # billboard tables made before the match keys need the generated columns added
+        sqls = ['ALTER TABLE billboard ADD COLUMN IF NOT EXISTS title_key varchar GENERATED ALWAYS AS (match_title(album_title)) STORED;',
+                'ALTER TABLE billboard ADD COLUMN IF NOT EXISTS artist_key varchar GENERATED ALWAYS AS (match_artists(credit_names)) STORED;',
+                ] + SQLer.create_indexes(next(table for table in SQLer.tables if table['name'] == 'billboard'))
+        self.execute(sqls)
+
     def drop_tables(self):
         print('\tdropping tables [WARNING]')
         self.execute(SQLer.drop_tables())
 
     def create_views(self):
+        # plain views and maintained tables read each other, so everything goes through the ordered deploy
         print('\tcreating views')
-        self.execute(SQLer.create_views() + SQLer.summarize_views())
+        self.deploy_views(force=True)
         
     def materialize_views(self):
         print('\tmaterializing views')
-        self.execute(SQLer.materialize_views())
+        self.refresh_views(force=True)
     
-    def refresh_views(self):
-        print('\trefreshing views')
-        self.execute(SQLer.refresh_views())
+    def refresh_views(self, force=False):
+        # rebuild views downstream of written tables and apply the deltas noted since the last refresh
+        # tables are noted in the database, so writes from a run that never refreshed are picked up here
+        noted_df = self.read_sql('SELECT delta_id, user_id, source_id, album_uri, table_name FROM _view_deltas;')
+        deltas_df = noted_df[noted_df['table_name'].isna()]
+        if force or (len(deltas_df) > self.delta_rows):
+            stale_views = [view['name'] for view in SQLer.materialized]
+        else:
+            stale_views = SQLer.get_stale_views(noted_df['table_name'].dropna().unique().tolist())
+
+        if not stale_views and deltas_df.empty:
+            if not noted_df.empty:
+                self.execute(self.get_applied_sql(noted_df))
+            print('\tno views to refresh')
+            return
+
+        print(f'\trefreshing views ({", ".join(stale_views) or "none"} in full, {len(deltas_df)} changes)')
+        scopes = {view['name']: self.get_delta_wheres(view, deltas_df)
+                  for view in SQLer.materialized if view['name'] not in stale_views}
+        sqls = SQLer.refresh_views(scopes)
+        sqls.append(self.get_applied_sql(noted_df))
+        self.execute(sqls)
+
+    def get_applied_sql(self, noted_df):
+        # remove only the deltas that were read, ids committed meanwhile can be lower than ones already seen
+        delta_ids = ', '.join(str(int(d)) for d in noted_df['delta_id'])
+        sql = (f'''
+               DELETE FROM _view_deltas WHERE delta_id IN ({delta_ids}) 
+               ;
+               ''')
+        return sql
+
+    def get_delta_wheres(self, view, deltas_df):
+        if view.get('scope') == 'none':
+            # views without users only change with their tables
+            return ''
+        elif view.get('scope') == 'user':
+            # views without album rows are refreshed for the whole user
+            users_df = deltas_df[deltas_df['user_id'].notna()]
+            rows_df = deltas_df.iloc[0:0]
+        else:
+            users_df = deltas_df[deltas_df['user_id'].notna() & deltas_df['album_uri'].isna()]
+            rows_df = deltas_df[deltas_df['user_id'].notna() & deltas_df['album_uri'].notna()]
+        
+        wheres = []
+        if not users_df.empty:
+            users = ', '.join(str(int(u)) for u in users_df['user_id'].unique())
+            wheres.append(f'user_id IN ({users})')
+        if not rows_df.empty:
+            rows = ', '.join(f'({int(u)}, {int(s)}, {self.dbify(a)})'
+                             for u, s, a in rows_df[['user_id', 'source_id', 'album_uri']].drop_duplicates().values)
+            wheres.append(f'(user_id, source_id, album_uri) IN ({rows})')
         
+        return ' OR '.join(wheres)
+
+    def get_delta_sql(self, user_id, source_id=None, album_uri=None):
+        sql = (f'''
+               INSERT INTO _view_deltas (user_id, source_id, album_uri) 
+               VALUES ({self.dbify(user_id)}, {self.dbify(source_id)}, {self.dbify(album_uri)}) 
+               ;
+               ''')
+        return sql
+        
+    def get_dirty_sql(self, table_names):
+        values = ', '.join(f'({self.dbify(table_name)})' for table_name in table_names)
+        sql = (f'''
+               INSERT INTO _view_deltas (table_name) VALUES {values} 
+               ;
+               ''')
+        return sql
+
+    def mark_dirty(self, table_names):
+        # note written tables for whichever run refreshes next
+        if table_names:
+            self.execute(self.get_dirty_sql(table_names))
+
     def drop_views(self):
         print('\tdropping views [WARNING]')
         self.execute(SQLer.drop_views())
 
+    def deploy_views(self, force=False, altered=[]):
+        # re-create only the objects whose definitions changed, plus everything built on them
+        # tables are never altered here, pass their names in altered once they have been changed by hand
+        deployed_df = self.read_sql('SELECT object_name, fingerprint FROM _schema_objects;')
+        deployed = dict(deployed_df[['object_name', 'fingerprint']].values)
+        objects = SQLer.get_objects()
+        differs = [obj['name'] for obj in objects if deployed.get(obj['name']) != SQLer.fingerprint(obj)]
+        changed = [obj['name'] for obj in objects if force or (obj['name'] in differs)]
+        if not changed:
+            print('\tviews are up to date')
+            return
+
+        unaltered = [obj['name'] for obj in objects if (obj['kind'] == 'table') and (obj['name'] in differs)
+                     and (obj['name'] in deployed) and (obj['name'] not in altered)]
+        for table_name in unaltered:
+            print(f'\ttable {table_name} changed and needs to be altered by hand')
+
+        rebuilds = SQLer.get_dependents(changed)
+        ordered = SQLer.sort_objects([obj for obj in objects if obj['name'] in rebuilds])
+        print(f'\tdeploying {len(ordered)} changed or dependent objects')
+        # only record what was actually created or replaced, so unaltered tables keep warning
+        self.execute(SQLer.deploy_objects(ordered, changed) +
+                     SQLer.record_fingerprints([obj for obj in objects if (obj['name'] in changed) and (obj['name'] not in unaltered)]))
+
+        if 'album_artists' in rebuilds:
+            self.update_critic_matches()
+        # maintained tables kept their rows but may now be out of date
+        self.mark_dirty([obj['name'] for obj in ordered if (obj['kind'] == 'materialized') and (obj['name'] not in changed)])
+        self.refresh_views()
+
         
     ''' ensure the right configuration is in place '''
-    def create_keywords(self, keywords_df):
-        pass
+    def create_keywords(self, keywords_df=None):
+        # load the keywords from the config and rebuild what reads them only when they changed
+        if keywords_df is None:
+            keywords_df = DataFrame([[k, str(p)] for k, v in NEON_KEYWORDS.items() for p in (v if isinstance(v, list) else [v])],
+                                    columns=['keyword', 'phrase'])
+        keywords_df = keywords_df.drop_duplicates().sort_values(['keyword', 'phrase'])
+        obj = {'name': '_keywords', 'kind': 'keywords', 'sql': keywords_df.to_json(orient='values')}
+        deployed_df = self.read_sql("SELECT fingerprint FROM _schema_objects WHERE object_name = '_keywords';")
+        if (not deployed_df.empty) and (deployed_df['fingerprint'].iloc[0] == SQLer.fingerprint(obj)):
+            print('\tkeywords are up to date')
+            return
+
+        print(f'\tloading {len(keywords_df)} keyword phrases')
+        names = ', '.join(self.dbify(k) for k in keywords_df['keyword'].unique())
+        values = ', '.join(f'({self.dbify(k)}, {self.dbify(p)})' for k, p in keywords_df.values)
+        sqls = [f'DELETE FROM keywords WHERE keyword IN ({names}) AND (keyword, phrase) NOT IN ({values});',
+                f'INSERT INTO keywords (keyword, phrase) VALUES {values} ON CONFLICT DO NOTHING;',
+                self.get_dirty_sql(['keywords']),
+                ] + SQLer.record_fingerprints([obj])
+        self.execute(sqls)
+
+        # everything computed from the phrases is out of date
+        self.update_track_titles()
+        self.update_album_categories()
 
     def add_service(self, service_name, sources=[], various_artists_id=None):
         sql = (f'''
@@ -169,16 +476,77 @@ class Neon:
             set_attributes.append(f'service_user_ids = service_user_ids || {self.dbify(service_user_ids)}')
         sets = ', '.join(set_attributes)
         sql = f'UPDATE profiles SET {sets} WHERE user_id = {user_id};'
-        self.execute(sql)
+        self.execute([sql, self.get_delta_sql(user_id)])
 
     ''' update data from pull '''
     def update_service_table(self, df, table_name, columns, pk_columns, service_id=None, source_id=None, update_only=False, drop=None,
-                             least_dates=[], greatest_dates=[]):
+                             least_dates=[], greatest_dates=[], bulk=None, chunk_rows=None, mark_dirty=True):
+        # drops need every row of the group at once to know what is missing
+        chunk_rows = max(len(df), 1) if drop else chunk_rows or self.chunk_rows
+        
+        stats = []
+        for i, start in enumerate(range(0, len(df), chunk_rows)):
+            chunk_df = df.iloc[start:start + chunk_rows]
+            stopwatch = time.time()
+            with self.session():
+                try:
+                    changed_rows = self.update_service_chunk(chunk_df, table_name, columns, pk_columns, service_id=service_id,
+                                                             source_id=source_id, update_only=update_only, drop=drop,
+                                                             least_dates=least_dates, greatest_dates=greatest_dates, bulk=bulk)
+                    updated = True
+                except Exception as e:
+                    print(f'...chunk {i + 1} of {table_name} failed due to {e}.')
+                    self.rollback()
+                    changed_rows = 0
+                    updated = False
+            seconds = time.time() - stopwatch
+            print(f'\t{table_name} chunk {i + 1}: {len(chunk_df)} rows {"written" if updated else "skipped"}, '
+                  f'{changed_rows} changed in {seconds:.2f}s')
+            stats.append({'table_name': table_name, 'chunk': i + 1, 'start_row': start, 'num_rows': len(chunk_df),
+                          'changed_rows': changed_rows, 'seconds': seconds, 'updated': updated})
+
+        stats_df = DataFrame(stats, columns=['table_name', 'chunk', 'start_row', 'num_rows', 'changed_rows', 'seconds', 'updated'])
+        if mark_dirty and (stats_df['changed_rows'].sum() > 0):
+            self.mark_dirty([table_name])
+        return stats_df
+
+    def update_service_chunk(self, df, table_name, columns, pk_columns, service_id=None, source_id=None, update_only=False, drop=None,
+                             least_dates=[], greatest_dates=[], bulk=None):
         # filter out columns that aren't in the df
         columns = [c for c in columns if c in df.columns]
         s_id = ['service_id'] if service_id else ['source_id'] if source_id else []
         s_id_v = f'{self.dbify(service_id)}, ' if service_id else f'{self.dbify(source_id)}, ' if source_id else ''
-        values = ', '.join('(' + s_id_v + ', '.join(self.dbify(v) for v in r) + ')' for r in df[columns].values)
+        if bulk is None:
+            bulk = len(df) >= self.copy_rows
+
+        if bulk:
+            # stream the rows into a staging table instead of writing them into the SQL
+            stage_name = f'_stage_{table_name}'
+            rows = f'SELECT {s_id_v}{", ".join(columns)} FROM {stage_name}'
+        else:
+            values = ', '.join('(' + s_id_v + ', '.join(self.dbify(v) for v in r) + ')' for r in df[columns].values)
+            rows = f'VALUES {values}'
+
+        sql = self.get_upsert_sql(rows, table_name, columns, pk_columns, s_id, update_only=update_only, drop=drop,
+                                  least_dates=least_dates, greatest_dates=greatest_dates)
+
+        if sql and bulk:
+            stage_sql = (f'''
+                         CREATE TEMP TABLE {stage_name} ON COMMIT DROP AS 
+                         SELECT {", ".join(columns)} FROM {table_name} WITH NO DATA 
+                         ;
+                         ''')
+            self.execute(stage_sql, commit=False)
+            self.copy_rows_in(df[columns], stage_name)
+
+        changed_rows = self.execute(sql)
+        if drop and len(df):
+            # the drop only counts deleted rows, so assume the upsert changed something
+            changed_rows = max(changed_rows, len(df))
+        return changed_rows
+
+    def get_upsert_sql(self, rows, table_name, columns, pk_columns, s_id, update_only=False, drop=None,
+                       least_dates=[], greatest_dates=[]):
         updatable = Counter(columns) != Counter(pk_columns)
             
         if drop or update_only:
@@ -191,18 +559,21 @@ class Neon:
             # upserting
             conflict_columns = ', '.join(s_id + pk_columns)
             excludes = ', '.join(f'{c} = EXCLUDED.{c}' for c in columns if c not in pk_columns)
-            do_update = f'UPDATE SET {excludes}' if updatable else 'NOTHING'
+            # skip rows that would not change, so the row count reflects real changes
+            olds = ', '.join(f'{table_name}.{c}' for c in columns if c not in pk_columns)
+            news = ', '.join(f'EXCLUDED.{c}' for c in columns if c not in pk_columns)
+            do_update = f'UPDATE SET {excludes} WHERE ({olds}) IS DISTINCT FROM ({news})' if updatable else 'NOTHING'
             sql = (f'''
-                   INSERT INTO {table_name} ({insert_columns}) VALUES {values} 
+                   INSERT INTO {table_name} ({insert_columns}) {rows} 
                    ON CONFLICT ({conflict_columns}) DO {do_update} 
                    ''')
         else:
             # updating
             if updatable:
-                sets = ', '.join(self.set_update_column(c, 'updt', '>' if c in greatest_dates else '<' if c in least_dates else '=') for c in columns if c not in s_id + pk_columns)
+                sets = ', '.join(self.set_update_column(c, 'updt', table_name, '>' if c in greatest_dates else '<' if c in least_dates else '=') for c in columns if c not in s_id + pk_columns)
                 ases = ', '.join(s_id + columns)
                 sql = (f'''
-                       UPDATE {table_name} SET {sets} FROM (VALUES {values}) 
+                       UPDATE {table_name} SET {sets} FROM ({rows}) 
                        AS updt({ases}) WHERE {wheres} 
                        ''')
             else:
@@ -210,25 +581,27 @@ class Neon:
                 
         if sql:
             if drop:
+                # keep whatever was sent, RETURNING leaves out the rows the upsert found unchanged
                 drops = ', '.join(drop)
                 sql = (f'''
-                       WITH upsert AS ({sql} RETURNING {conflict_columns}) 
-                       DELETE FROM {table_name} WHERE ({drops}) IN (SELECT DISTINCT {drops} FROM upsert) 
-                       AND ({conflict_columns}) NOT IN (SELECT {conflict_columns} FROM upsert) 
+                       WITH incoming ({insert_columns}) AS ({rows}), 
+                       upsert AS ({sql}) 
+                       DELETE FROM {table_name} WHERE ({drops}) IN (SELECT DISTINCT {drops} FROM incoming) 
+                       AND ({conflict_columns}) NOT IN (SELECT {conflict_columns} FROM incoming) 
                        ''')
             sql += ';'
-            
-        self.execute(sql)
+
+        return sql
         
-    def set_update_column(self, column, alias, comparison='='):
+    def set_update_column(self, column, alias, table_name, comparison='='):
         ## need somethign for when it already exists, don't update a particular column
         match comparison:
             case '=':
                 update = f'{alias}.{column}'
             case '>':
-                update = f'GREATEST({column}, {alias.column})'
+                update = f'GREATEST({table_name}.{column}, {alias}.{column})'
             case '<':
-                update = f'LEAST({column}, {alias.column})'
+                update = f'LEAST({table_name}.{column}, {alias}.{column})'
         update_column = f'{column} = {update}'
         return update_column
 
@@ -246,53 +619,228 @@ class Neon:
             
     def update_artists(self, artists_df, service_id):
         columns = ['artist_uri', 'artist_name']
-        self.update_service_table(artists_df, 'artists', columns, ['artist_uri'], service_id=service_id)
+        return self.update_service_table(artists_df, 'artists', columns, ['artist_uri'], service_id=service_id)
         
     def update_albums(self, albums_df, source_id):
         columns = ['album_uri', 'artist_uris', 'album_name', 'album_type', 
                    'release_date', 'image_src', 'album_duration',
                    'track_uris', 'upc']
-        self.update_service_table(albums_df, 'albums', columns, ['album_uri'], source_id=source_id)
+        stats_df = self.update_service_table(albums_df, 'albums', columns, ['album_uri'], source_id=source_id)
+        self.update_album_tracks(source_id)
+        if stats_df['changed_rows'].sum():
+            self.update_critic_matches(source_id)
+            albums = ', '.join(self.dbify(a) for a in albums_df['album_uri'])
+            self.update_album_categories(f'source_id = {self.dbify(source_id)} AND album_uri IN ({albums})')
+        return stats_df
+
+    def update_album_tracks(self, source_id=None):
+        # keep the normalized album_tracks rows in step with albums.track_uris
+        delete_wheres = f'AND album_tracks.source_id = {self.dbify(source_id)}' if source_id else ''
+        insert_wheres = f'WHERE source_id = {self.dbify(source_id)}' if source_id else ''
+        sqls = [(f'''
+                 DELETE FROM album_tracks WHERE NOT EXISTS 
+                 (SELECT 1 FROM albums, jsonb_array_elements_text(track_uris) WITH ORDINALITY AS elem(track_uri, track_num) 
+                 WHERE albums.source_id = album_tracks.source_id AND albums.album_uri = album_tracks.album_uri 
+                 AND elem.track_num = album_tracks.track_num AND elem.track_uri = album_tracks.track_uri) {delete_wheres} 
+                 ;
+                 '''),
+                (f'''
+                 INSERT INTO album_tracks (source_id, album_uri, track_num, track_uri) 
+                 SELECT source_id, album_uri, elem.track_num, elem.track_uri 
+                 FROM albums, jsonb_array_elements_text(track_uris) WITH ORDINALITY AS elem(track_uri, track_num) 
+                 {insert_wheres} 
+                 ON CONFLICT (source_id, album_uri, track_num) DO UPDATE SET track_uri = EXCLUDED.track_uri 
+                 WHERE album_tracks.track_uri <> EXCLUDED.track_uri 
+                 ;
+                 '''),
+                ]
+        if self.execute(sqls):
+            self.mark_dirty(['album_tracks'])
         
+    def update_critic_matches(self, source_id=None):
+        # resolve critic list entries to albums once, on the exact title first and then the artist names
+        delete_wheres = f'AND critic_matches.source_id = {self.dbify(source_id)}' if source_id else ''
+        insert_wheres = f'AND albums.source_id = {self.dbify(source_id)}' if source_id else ''
+        stage_sql = (f'''
+                     CREATE TEMP TABLE _stage_critic_matches ON COMMIT DROP AS 
+                     SELECT source_id, album_uri, critic_name, list_year, list_position 
+                     FROM critics JOIN albums USING (album_name) JOIN album_artists USING (source_id, album_uri) 
+                     WHERE EXISTS (SELECT 1 FROM jsonb_array_elements_text(critics.artist_names) AS critic_artists(artist_name) 
+                     WHERE lower(album_artists.artist_names::text) LIKE '%' || lower(artist_name) || '%') {insert_wheres} 
+                     ;
+                     ''')
+        columns = 'source_id, album_uri, critic_name, list_year, list_position'
+        sqls = [(f'''
+                 DELETE FROM critic_matches WHERE ({columns}) NOT IN 
+                 (SELECT {columns} FROM _stage_critic_matches) {delete_wheres} 
+                 ;
+                 '''),
+                (f'''
+                 INSERT INTO critic_matches ({columns}) 
+                 SELECT {columns} FROM _stage_critic_matches 
+                 ON CONFLICT DO NOTHING 
+                 ;
+                 '''),
+                ]
+        # the matches are worked out once and read by both statements
+        with self.session():
+            self.execute(stage_sql, commit=False)
+            changed_rows = self.execute(sqls)
+        if changed_rows:
+            self.mark_dirty(['critic_matches'])
+
     def update_ownerships(self, ownerships_df, source_id, user_id):
         columns = ['user_id', 'album_uri', 'like_date']
         ownerships_df['user_id'] = user_id
         drop = ['user_id', 'source_id']
-        self.update_service_table(ownerships_df, 'ownerships', columns, ['user_id', 'album_uri'], source_id=source_id,
-                                  drop=drop)
+        # ownership changes are refreshed per user through the deltas
+        stats_df = self.update_service_table(ownerships_df, 'ownerships', columns, ['user_id', 'album_uri'], source_id=source_id,
+                                             drop=drop, mark_dirty=False)
+        self.execute(self.get_delta_sql(user_id))
+        return stats_df
         
     def update_tracks(self, tracks_df, service_id):
         columns = ['track_uri', 'track_name', 'track_duration', 'artist_uris', 'isrc', 'explicit']
-        self.update_service_table(tracks_df, 'tracks', columns, ['track_uri'], service_id=service_id)
+        stats_df = self.update_service_table(tracks_df, 'tracks', columns, ['track_uri'], service_id=service_id)
+        self.update_track_titles(service_id, tracks_df['track_uri'].tolist())
+        if stats_df['changed_rows'].sum():
+            tracks = ', '.join(self.dbify(t) for t in tracks_df['track_uri'])
+            self.update_album_categories(self.get_track_album_wheres(f'service_id = {self.dbify(service_id)} AND track_uri IN ({tracks})'))
+        return stats_df
+
+    def update_track_titles(self, service_id=None, track_uris=None):
+        # title stems and keyword flags are worked out once per track so skips are an equality join
+        # titles that are all brackets keep their full name rather than sharing an empty stem
+        wheres = ''
+        if service_id:
+            wheres += f' AND service_id = {self.dbify(service_id)}'
+        if track_uris:
+            wheres += f' AND track_uri IN ({", ".join(self.dbify(t) for t in track_uris)})'
+        columns = ['title_stem', 'good_repeat', 'bad_repeat', 'good_short']
+        sql = (f'''
+               WITH regexes AS (SELECT 
+               (SELECT '%(' || string_agg(phrase, '|') || ')%' FROM keywords WHERE keyword = 'good_repeat') AS good_repeat, 
+               (SELECT '%(' || string_agg(phrase, '|') || ')%' FROM keywords WHERE keyword = 'bad_repeat') AS bad_repeat, 
+               (SELECT '%(' || string_agg(phrase, '|') || ')%' FROM keywords WHERE keyword = 'good_short') AS good_short) 
+               
+               INSERT INTO track_titles (service_id, track_uri, {", ".join(columns)}) 
+               SELECT service_id, track_uri, 
+               COALESCE(NULLIF(regexp_replace(lower(track_name), '\\s*(\\(.*|\\[.*|\\s-\\s.*)$', ''), ''), lower(track_name)), 
+               COALESCE(lower(track_name) SIMILAR TO regexes.good_repeat, FALSE), 
+               COALESCE(lower(track_name) SIMILAR TO regexes.bad_repeat, FALSE), 
+               COALESCE(lower(track_name) SIMILAR TO regexes.good_short, FALSE) 
+               FROM tracks, regexes WHERE track_name IS NOT NULL{wheres} 
+               ON CONFLICT (service_id, track_uri) DO UPDATE SET 
+               {", ".join(f"{c} = EXCLUDED.{c}" for c in columns)} 
+               WHERE ({", ".join(f"track_titles.{c}" for c in columns)}) IS DISTINCT FROM ({", ".join(f"EXCLUDED.{c}" for c in columns)}) 
+               ;
+               ''')
+        if self.execute(sql):
+            self.mark_dirty(['track_titles'])
+
+    def update_album_categories(self, wheres=None):
+        # categorize only the albums that may have changed and note their owners for the view deltas
+        album_wheres = f'WHERE {wheres}' if wheres else ''
+        sql = (f'''
+               WITH thresholds AS (SELECT 
+               (SELECT '%(' || string_agg(phrase, '|') || ')%' FROM keywords WHERE keyword = 'soundtrack') AS soundtrack_words, 
+               (SELECT min(phrase::numeric) FROM keywords WHERE keyword = 'score_instrumental') AS min_instrumentalness, 
+               (SELECT min(phrase::numeric) FROM keywords WHERE keyword = 'min_ep_tracks') AS min_ep_tracks, 
+               (SELECT min(phrase::numeric) FROM keywords WHERE keyword = 'min_release_span') AS min_release_span), 
+               
+               changed_albums AS (SELECT source_id, album_uri, album_type, album_name, track_uris, upc FROM albums {album_wheres}), 
+               
+               instrumentals AS (SELECT source_id, album_uri, AVG(instrumentalness) AS instrumentalness 
+               FROM changed_albums JOIN album_tracks USING (source_id, album_uri) JOIN sources USING (source_id) 
+               JOIN tracks USING (service_id, track_uri) 
+               GROUP BY source_id, album_uri), 
+               
+               release_years AS (SELECT source_id, album_uri, max(release_year) - min(release_year) AS release_span 
+               FROM changed_albums JOIN album_tracks USING (source_id, album_uri) JOIN sources USING (source_id) 
+               JOIN tracks USING (service_id, track_uri) JOIN recordings USING (isrc) JOIN works USING (iswc) 
+               GROUP BY source_id, album_uri), 
+               
+               categories AS (SELECT source_id, album_uri, 
+               CASE WHEN album_type = 'single' AND jsonb_array_length(track_uris) >= min_ep_tracks THEN 'ep' 
+               WHEN album_type in ('album', 'compilation') THEN 
+               (CASE WHEN lower(album_name) SIMILAR TO soundtrack_words OR release_type = 'soundtrack' THEN 
+               (CASE WHEN instrumentalness >= min_instrumentalness THEN 'score' ELSE 'soundtrack' END) 
+               WHEN release_type = 'compilation' AND release_span >= min_release_span THEN 'compilation' 
+               WHEN album_type = 'album' THEN 'studio' ELSE album_type END) ELSE album_type END AS category 
+               FROM changed_albums LEFT JOIN instrumentals USING (source_id, album_uri) 
+               LEFT JOIN release_years USING (source_id, album_uri) LEFT JOIN barcodes USING (upc), thresholds), 
+               
+               changed_categories AS (INSERT INTO album_categories (source_id, album_uri, category) 
+               SELECT source_id, album_uri, category FROM categories 
+               ON CONFLICT (source_id, album_uri) DO UPDATE SET category = EXCLUDED.category 
+               WHERE album_categories.category IS DISTINCT FROM EXCLUDED.category 
+               RETURNING source_id, album_uri) 
+               
+               INSERT INTO _view_deltas (user_id, source_id, album_uri) 
+               SELECT user_id, source_id, album_uri FROM ownerships JOIN changed_categories USING (source_id, album_uri) 
+               ;
+               ''')
+        self.execute(sql)
+
+    def get_track_album_wheres(self, track_wheres, joins=''):
+        # the albums holding any of the matching tracks
+        return (f'(source_id, album_uri) IN (SELECT source_id, album_uri FROM album_tracks JOIN sources USING (source_id) '
+                f'JOIN tracks USING (service_id, track_uri) {joins}WHERE {track_wheres})')
 
     def update_soundtracks(self, tracks_df, service_id):
         columns = ['track_uri', 'instrumentalness']
-        self.update_service_table(tracks_df, 'tracks', columns, ['track_uri'], service_id=service_id, update_only=True)
+        stats_df = self.update_service_table(tracks_df, 'tracks', columns, ['track_uri'], service_id=service_id, update_only=True)
+        if stats_df['changed_rows'].sum():
+            tracks = ', '.join(self.dbify(t) for t in tracks_df['track_uri'])
+            self.update_album_categories(self.get_track_album_wheres(f'service_id = {self.dbify(service_id)} AND track_uri IN ({tracks})'))
+        return stats_df
 
     def update_recordings(self, tracks_df):
         columns = ['isrc', 'iswc']
-        self.update_service_table(tracks_df, 'recordings', columns, ['isrc'])
+        stats_df = self.update_service_table(tracks_df, 'recordings', columns, ['isrc'])
+        if stats_df['changed_rows'].sum():
+            isrcs = ', '.join(self.dbify(i) for i in tracks_df['isrc'])
+            self.update_album_categories(self.get_track_album_wheres(f'isrc IN ({isrcs})'))
+        return stats_df
 
     def update_works(self, tracks_df):
         columns = ['iswc', 'release_year']
-        self.update_service_table(tracks_df, 'works', columns, ['iswc'])
+        stats_df = self.update_service_table(tracks_df, 'works', columns, ['iswc'])
+        if stats_df['changed_rows'].sum():
+            iswcs = ', '.join(self.dbify(i) for i in tracks_df['iswc'])
+            self.update_album_categories(self.get_track_album_wheres(f'iswc IN ({iswcs})', joins='JOIN recordings USING (isrc) '))
+        return stats_df
 
     def update_upcs(self, albums_df):
         columns = ['source_id', 'album_uri', 'upc']
-        self.update_service_table(albums_df, 'albums', columns, ['source_id', 'album_uri'])
+        stats_df = self.update_service_table(albums_df, 'albums', columns, ['source_id', 'album_uri'])
+        if stats_df['changed_rows'].sum():
+            albums = ', '.join(f'({int(s)}, {self.dbify(a)})' for s, a in albums_df[['source_id', 'album_uri']].values)
+            self.update_album_categories(f'(source_id, album_uri) IN ({albums})')
+        return stats_df
         
     def update_barcodes(self, albums_df):
         columns = ['upc', 'release_type']
-        self.update_service_table(albums_df, 'barcodes', columns, ['upc'])
+        stats_df = self.update_service_table(albums_df, 'barcodes', columns, ['upc'])
+        if stats_df['changed_rows'].sum():
+            upcs = ', '.join(self.dbify(u) for u in albums_df['upc'])
+            self.update_album_categories(f'upc IN ({upcs})')
+        return stats_df
 
     def update_billboard(self, peaks_df, start_date, end_date):
         columns = ['credit_names', 'album_title', 'peak_position']
-        self.update_service_table(peaks_df, 'billboard', columns, ['credit_names', 'album_title'])
-        self.update_data_updates('billboard', start_date, end_date)
+        stats_df = self.update_service_table(peaks_df, 'billboard', columns, ['credit_names', 'album_title'])
+        if stats_df['updated'].all():
+            # only move the window forward once every chunk landed
+            self.update_data_updates('billboard', start_date, end_date)
+        return stats_df
 
     def update_critics(self, lists_df):
         columns = ['critic_name', 'list_year', 'list_position', 'album_name', 'artist_names']
-        self.update_service_table(lists_df, 'critics', columns, ['critic_name', 'list_year', 'list_position'])
+        stats_df = self.update_service_table(lists_df, 'critics', columns, ['critic_name', 'list_year', 'list_position'])
+        if stats_df['changed_rows'].sum():
+            self.update_critic_matches()
+        return stats_df
         
     # # def update_series(self, user_id, series_name, artist_uri=None, artist_name=None, album_name_pattern=None, album_not_pattern=None):
     # #     artist_yes = f'artist_uris ? {self.dbify(artist_uri)}' if artist_uri else None
@@ -313,132 +861,211 @@ class Neon:
 
 
     ''' remove albums and details no longer needed '''
-    def remove_items(self, table_name, columns):
-        wheres = ', '.join(columns)
-        sql = (f'''
-               DELETE FROM {table_name} WHERE ({wheres}) IN 
-               (SELECT {wheres} IN _ophran_{table_name})
-               ''')
-        self.execute(sql)
-        
-    def remove_orphans(self):
-        for table in SQLer.orphans:
-            self.remove_items(table['name'][len('_orphan_'):], table['columns'])
-            
+    def remove_items(self, orphan, keys_df):
+        # check the batch is still orphaned at delete time and give up rather than wait on a lock
+        columns = ', '.join(orphan['columns'])
+        values = ', '.join('(' + ', '.join(self.dbify(v) for v in r) + ')' for r in keys_df.values)
+        sqls = [f"SET LOCAL lock_timeout = '{self.orphan_lock_timeout}s';",
+                (f'''
+                 DELETE FROM {orphan["table"]} WHERE ({columns}) IN (VALUES {values}) 
+                 AND ({columns}) IN (SELECT {columns} FROM ({orphan["sql"]}) AS {orphan["name"]} WHERE ({columns}) IN (VALUES {values})) 
+                 ;
+                 '''),
+                ]
+        return self.execute(sqls)
+
+    def stage_refs(self, orphan):
+        # expand the references once for the whole table instead of once per batch
+        # an artist credited after staging can be deleted, update_artists picks it up again
+        self.execute(['DROP TABLE IF EXISTS _orphan_refs;',
+                      f'CREATE TEMP TABLE _orphan_refs AS {orphan["refs"]};',
+                      'ANALYZE _orphan_refs;'])
+
+    def remove_table_orphans(self, orphan, dry_run, batch_rows):
+        keys_df = self.read_sql(f'SELECT {", ".join(orphan["columns"])} FROM ({orphan["sql"]}) AS {orphan["name"]};')
+        removed_rows = 0
+        failed_batches = 0
+        if not dry_run:
+            for i, start in enumerate(range(0, len(keys_df), batch_rows)):
+                try:
+                    removed_rows += self.remove_items(orphan, keys_df.iloc[start:start + batch_rows])
+                except Exception as e:
+                    self.rollback()
+                    print(f'...batch {i + 1} of {orphan["table"]} orphans failed due to {e}.')
+                    failed_batches += 1
+        return len(keys_df), removed_rows, failed_batches
+
+    def remove_orphans(self, dry_run=False, batch_rows=None):
+        # find each table's orphans with one anti-join and delete them in short transactions, parents first
+        # so rows orphaned by an earlier table's deletes are found when their own table comes up in the same run
+        # a dry run deletes nothing, so past the first table its counts are only a lower bound
+        batch_rows = batch_rows or self.orphan_rows
+        stats = []
+        with self.session():
+            for i, orphan in enumerate(SQLer.orphans):
+                stopwatch = time.time()
+                try:
+                    if 'refs' in orphan:
+                        self.stage_refs(orphan)
+                    orphan_rows, removed_rows, failed_batches = self.remove_table_orphans(orphan, dry_run, batch_rows)
+                finally:
+                    if 'refs' in orphan:
+                        self.execute('DROP TABLE IF EXISTS _orphan_refs;')
+                if removed_rows:
+                    self.mark_dirty([orphan['table']])
+                seconds = time.time() - stopwatch
+                lower_bound = dry_run and (i > 0)
+                print(f'\t{orphan["table"]}: {"at least " if lower_bound else ""}{orphan_rows} orphans found, '
+                      f'{"none removed (dry run)" if dry_run else f"{removed_rows} removed"} in {seconds:.2f}s')
+                stats.append({'table_name': orphan['table'], 'orphan_rows': orphan_rows, 'lower_bound': lower_bound,
+                              'removed_rows': removed_rows, 'failed_batches': failed_batches, 'seconds': seconds,
+                              'dry_run': dry_run})
+
+        stats_df = DataFrame(stats, columns=['table_name', 'orphan_rows', 'lower_bound', 'removed_rows', 'failed_batches',
+                                             'seconds', 'dry_run'])
+        return stats_df
+
 
     ''' manual changes '''       
     def update_album_rating(self, user_id, source_id, album_uri, rating):
+        self.execute(self.get_album_rating_sqls(user_id, source_id, album_uri, rating))
+
+    def get_album_rating_sqls(self, user_id, source_id, album_uri, rating):
         # need to ensure that rankings are adjusted -- can't have a B+ album above an A-
         sql = (f'''
                UPDATE ownerships SET rating = {rating} WHERE user_id = {self.dbify(user_id)} 
                AND source_id = {self.dbify(source_id)} AND album_uri = {self.dbify(album_uri)} 
                ;
                ''')
-        self.execute(sql)
+        return [sql, self.get_delta_sql(user_id, source_id, album_uri)] + self.get_summary_sqls(user_id)
+
+    def get_summary_sqls(self, user_id):
+        return SQLer.refresh_view(SQLer.get_materialized('album_summaries'), f'user_id = {user_id}')
 
-    def get_album_comparisons(self, user_id, excluded_categories=['single', 'playlist'], allow_repeats=False):
+    def get_album_comparisons(self, user_id, excluded_categories=['single', 'playlist'], allow_repeats=False, strategy='random',
+                              tries=Pairer.tries):
         if excluded_categories:
             excludes = 'AND category NOT IN (' + ', '.join(f"'{c}'" for c in excluded_categories) + ') '
         else:
             excludes = ''
-            
-        if allow_repeats:
-            owned_with = (f'''
-                          owned_categories AS 
-                          (SELECT category FROM release_categories WHERE category IN 
-                          (SELECT category FROM availabe_categories WHERE num_albums > 1)), 
-                          ''')
-            first_pick_where = 'WHERE category IN (SELECT category FROM owned_categories) '
-            second_pick_where = ''
 
-        else:
-            owned_with = ''
-            first_pick_where = 'JOIN availabe_categories USING (user_id, category) WHERE num_played < num_albums '            
-            second_pick_where = 'AND NOT (SELECT played FROM first_pick) @> jsonb_build_array(source_id, album_uri) '
+        # random takes the first draws as they come, informative looks at a few draws for each pick and keeps
+        # the least played first album and the second album that would tell the most about the order
+        informative = strategy == 'informative'
+        first_tries = tries if informative else 1
+        second_tries = 1 if (allow_repeats and not informative) else tries
+        first_order = 'games, ' if informative else ''
+        played = (f'''
+                  EXISTS (SELECT 1 FROM battles WHERE battles.user_id = {user_id} AND 
+                  ((winner_source_id, winner_uri, loser_source_id, loser_uri) = (f.source_id, f.album_uri, c.source_id, c.album_uri) OR 
+                  (winner_source_id, winner_uri, loser_source_id, loser_uri) = (c.source_id, c.album_uri, f.source_id, f.album_uri))), 
+                  ''') if not allow_repeats else ''
+        information = Pairer.get_sql(f'COALESCE(r.score, {Elo.base})', 'f.score', 'COALESCE(r.games, 0)', 'f.games')
+        second_order = f'{played}{information + " DESC, " if informative else ""}'
 
+        # categories are weighted by size so every album is equally likely to come up first,
+        # then both picks are index lookups on random ordinals within the category
         sql = (f'''
-               WITH release_categories AS 
-               (SELECT user_id, source_id, album_uri, category, 
-               COALESCE(wins || losses, jsonb_build_array(NULL)) AS played, 
-               COALESCE(jsonb_array_length(wins || losses), 0) AS num_played 
-               FROM ownerships JOIN album_categories USING (source_id, album_uri) 
-               WHERE user_id = {user_id} {excludes}), 
+               WITH pool AS 
+               (SELECT category, num_albums FROM album_pools WHERE user_id = {user_id} AND num_albums > 1 {excludes} 
+               ORDER BY -ln(1.0 - random()) / num_albums LIMIT 1), 
                
-               availabe_categories AS 
-               (SELECT user_id, category, COUNT(*) AS num_albums FROM release_categories 
-               GROUP BY category, user_id), 
+               first_draws AS 
+               (SELECT n, floor(random() * num_albums)::integer AS ordinal 
+               FROM pool, generate_series(1, {first_tries}) AS n), 
                
-               {owned_with} 
-              
                first_pick AS 
-               (SELECT source_id, album_uri, category, played FROM release_categories 
-               {first_pick_where} 
-               ORDER BY RANDOM() LIMIT 1), 
-
+               (SELECT c.source_id, c.album_uri, c.category, c.ordinal, 
+               COALESCE(r.score, {Elo.base}) AS score, COALESCE(r.games, 0) AS games 
+               FROM first_draws JOIN album_candidates AS c 
+               ON (c.user_id, c.category, c.ordinal) = ({user_id}, (SELECT category FROM pool), first_draws.ordinal) 
+               LEFT JOIN album_ratings AS r ON (r.user_id, r.source_id, r.album_uri) = ({user_id}, c.source_id, c.album_uri) 
+               ORDER BY {first_order}n LIMIT 1), 
+               
+               second_draws AS 
+               (SELECT n, (ordinal + 1 + floor(random() * (num_albums - 1))::integer) % num_albums AS ordinal 
+               FROM first_pick, pool, generate_series(1, {second_tries}) AS n), 
+               
                second_pick AS 
-               (SELECT source_id, album_uri, category FROM release_categories 
-               WHERE category = (SELECT category FROM first_pick) 
-               AND (source_id, album_uri) != (SELECT source_id, album_uri FROM first_pick) 
-               {second_pick_where} 
-               ORDER BY RANDOM() LIMIT 1), 
+               (SELECT c.source_id, c.album_uri, c.category FROM second_draws JOIN album_candidates AS c 
+               ON (c.user_id, c.category, c.ordinal) = ({user_id}, (SELECT category FROM pool), second_draws.ordinal) 
+               LEFT JOIN album_ratings AS r ON (r.user_id, r.source_id, r.album_uri) = ({user_id}, c.source_id, c.album_uri) 
+               CROSS JOIN first_pick AS f 
+               ORDER BY {second_order}n LIMIT 1), 
                
                picks AS (SELECT source_id, album_uri, category FROM first_pick 
-               UNION SELECT source_id, album_uri, category FROM second_pick)  
+               UNION ALL SELECT source_id, album_uri, category FROM second_pick) 
 
                SELECT user_id, source_id, album_uri, category, album_name, artist_names, ranking, image_src 
                FROM picks JOIN albums USING (source_id, album_uri) 
                JOIN ownerships USING (source_id, album_uri) JOIN sources USING (source_id) 
                JOIN album_artists USING (source_id, album_uri) 
                LEFT JOIN release_battles USING (user_id, source_id, album_uri) 
+               WHERE user_id = {user_id} 
                ;
                ''')
         albums_df = self.read_sql(sql)
         return albums_df
         
-    def update_album_comparisons(self, user_id, source_id_1, album_uri_1, source_id_2, album_uri_2, winner):
+    def update_album_comparisons(self, user_id, source_id_1, album_uri_1, source_id_2, album_uri_2, winner, category=None):
+        self.execute(self.get_album_comparison_sqls(user_id, source_id_1, album_uri_1, source_id_2, album_uri_2, winner,
+                                                    category=category))
+
+    def get_album_comparison_sqls(self, user_id, source_id_1, album_uri_1, source_id_2, album_uri_2, winner, category=None):
         albums = [(source_id_1, album_uri_1), (source_id_2, album_uri_2)]
         source_id_w, album_uri_w = albums[winner - 1]
         source_id_l, album_uri_l = albums[2 - winner]
         
-        # update winner and loser
-        where_w = f"{user_id}, {source_id_w}, '{album_uri_w}'"
-        winner = self.dbify([source_id_w, album_uri_w])
-        where_l = f"{user_id}, {source_id_l}, '{album_uri_l}'"
-        loser = self.dbify([source_id_l, album_uri_l])
+        # only the latest decision between two albums counts for battles, ratings move with every decision
+        winner = f'{source_id_w}, {self.dbify(album_uri_w)}'
+        loser = f'{source_id_l}, {self.dbify(album_uri_l)}'
+        category = self.dbify(category) if category else \
+            f'(SELECT category FROM album_categories WHERE (source_id, album_uri) = ({winner}))'
         sqls = [(f'''
-                 WITH win_list_w AS 
-                 (SELECT jsonb_array_elements(wins) AS win_value FROM ownerships 
-                 WHERE (user_id, source_id, album_uri) = ({where_w})), 
-                      
-                 loss_list_w AS 
-                 (SELECT jsonb_array_elements(losses) AS loss_value FROM ownerships 
-                 WHERE (user_id, source_id, album_uri) = ({where_w})) 
-                      
-                 UPDATE ownerships SET 
-                 wins = jsonb_build_array({loser}) || 
-                 COALESCE((SELECT jsonb_agg(win_value) FROM win_list_w WHERE win_value <> {loser}), '[]'::jsonb), 
-                 losses = (SELECT jsonb_agg(loss_value) FROM loss_list_w WHERE loss_value <> {loser}) 
-                 WHERE (user_id, source_id, album_uri) = ({where_w}) 
+                 WITH previous AS 
+                 (DELETE FROM battles WHERE user_id = {user_id} AND 
+                 ((winner_source_id, winner_uri, loser_source_id, loser_uri) = ({winner}, {loser}) OR 
+                 (winner_source_id, winner_uri, loser_source_id, loser_uri) = ({loser}, {winner}))), 
+                 
+                 decided AS 
+                 (INSERT INTO battles (user_id, winner_source_id, winner_uri, loser_source_id, loser_uri) 
+                 VALUES ({user_id}, {winner}, {loser}) 
+                 ON CONFLICT (user_id, winner_source_id, winner_uri, loser_source_id, loser_uri) 
+                 DO UPDATE SET decided_at = now()), 
+                 
+                 players AS 
+                 (SELECT p.source_id, p.album_uri, won, COALESCE(score, {Elo.base}) AS score 
+                 FROM (VALUES ({winner}, 1), ({loser}, 0)) AS p (source_id, album_uri, won) 
+                 LEFT JOIN album_ratings AS r ON (r.user_id, r.source_id, r.album_uri) = ({user_id}, p.source_id, p.album_uri)), 
+                 
+                 scores AS 
+                 (SELECT source_id, album_uri, won, 
+                 {Elo.get_sql('score', '(SELECT sum(score) FROM players) - score', 'won')} AS score 
+                 FROM players) 
+                 
+                 INSERT INTO album_ratings (user_id, source_id, album_uri, category, score, games, wins) 
+                 SELECT {user_id}, source_id, album_uri, {category}, score, 1, won FROM scores 
+                 ON CONFLICT (user_id, source_id, album_uri) DO UPDATE SET 
+                 category = EXCLUDED.category, score = EXCLUDED.score, 
+                 games = album_ratings.games + 1, wins = album_ratings.wins + EXCLUDED.wins, rated_at = now() 
                  ;
                  '''),
-                (f'''
-                 WITH win_list_l AS 
-                 (SELECT jsonb_array_elements(wins) AS win_value FROM ownerships 
-                 WHERE (user_id, source_id, album_uri) = ({where_l})), 
-                     
-                 loss_list_l AS 
-                 (SELECT jsonb_array_elements(losses) AS loss_value FROM ownerships 
-                 WHERE (user_id, source_id, album_uri) = ({where_l})) 
-                      
-                 UPDATE ownerships SET 
-                 wins = (SELECT jsonb_agg(win_value) FROM win_list_l WHERE win_value <> {winner}), 
-                 losses = jsonb_build_array({winner}) || 
-                 COALESCE((SELECT jsonb_agg(loss_value) FROM loss_list_l WHERE loss_value <> {winner}), '[]'::jsonb) 
-                 WHERE (user_id, source_id, album_uri) = ({where_l}) 
-                 ;
-                 '''),
-                ]
-        self.execute(sqls)
+                # rankings shift across the whole category
+                self.get_delta_sql(user_id),
+                ] + self.get_summary_sqls(user_id)
+        return sqls
+
+    def rebuild_album_ratings(self, user_id=None):
+        wheres = f'WHERE user_id = {user_id}' if user_id else ''
+        battles_df = self.read_sql(f'SELECT * FROM battles {wheres};')
+        categories_df = self.read_sql('SELECT source_id, album_uri, category FROM album_categories;')
+        categories = {(s, a): c for s, a, c in categories_df[['source_id', 'album_uri', 'category']].values}
+        
+        print(f'\trebuilding album ratings from {len(battles_df)} battles')
+        self.execute(f'DELETE FROM album_ratings {wheres};')
+        ratings_df = Elo.replay(battles_df, categories)
+        columns = ['user_id', 'source_id', 'album_uri', 'category', 'score', 'games', 'wins']
+        return self.update_service_table(ratings_df, 'album_ratings', columns, ['user_id', 'source_id', 'album_uri'])
 
     def get_album_to_rate(self, user_id, unrated=False):
         wheres = ' AND rating IS NULL ' if unrated else ''
@@ -456,19 +1083,151 @@ class Neon:
     def get_album_summary(self, user_id, max_ranking=5):
         categories = ['studio', 'compilation', 'soundtrack', 'score']
         cases = ' '.join(f"WHEN '{category}' THEN {i}" for i, category in enumerate(categories)) + f' ELSE {len(categories)}'
+        if max_ranking <= NEON_SUMMARY_RANKS:
+            # album_summaries keeps the top of each category and is kept current as results are written
+            summaries = 'album_summaries'
+        else:
+            # deeper than the maintained table goes, walk the ratings index for the top of each category
+            summaries = (f'''
+                         (SELECT user_id, category, source_id, album_uri, artist_names, album_name, ranking, rating 
+                         FROM (SELECT DISTINCT category FROM album_ratings WHERE user_id = {user_id}) AS rated_categories 
+                         CROSS JOIN LATERAL 
+                         (SELECT source_id, album_uri, RANK() OVER (ORDER BY score DESC) AS ranking FROM album_ratings 
+                         WHERE user_id = {user_id} AND album_ratings.category = rated_categories.category 
+                         ORDER BY score DESC LIMIT {max_ranking}) AS tops 
+                         JOIN ownerships USING (source_id, album_uri) 
+                         JOIN albums USING (source_id, album_uri) JOIN album_artists USING (source_id, album_uri)) AS album_summaries 
+                         ''')
         sql = (f'''
-               SELECT artist_names, album_name, category, ranking, rating 
-               FROM ownerships JOIN release_battles USING (user_id, source_id, album_uri) 
-               JOIN album_categories USING (source_id, album_uri) 
-               JOIN albums USING (source_id, album_uri) JOIN sources USING (source_id) 
-               JOIN album_artists USING (source_id, album_uri) 
-               WHERE user_id = {user_id} AND release_battles.ranking <= {max_ranking} 
+               SELECT artist_names, album_name, category, ranking, rating FROM {summaries} 
+               WHERE user_id = {user_id} AND ranking <= {max_ranking} 
                ORDER BY CASE category {cases} END, ranking ASC, rating DESC 
                ;
                ''')
         albums_df = self.read_sql(sql)
         return albums_df
 
+    ''' work queues '''
+    def get_queue_keys(self, table_name):
+        return next(uv['keys'] for uv in SQLer.updates if uv['name'] == f'update_{table_name}')
+
+    def get_queue_owner(self):
+        return f'{gethostname()}:{getpid()}'
+
+    def fill_queue(self, table_name):
+        # evaluate the update view once, add new work items and drop unleased ones that are no longer needed
+        keys = self.get_queue_keys(table_name)
+        item_key = 'jsonb_build_object(' + ', '.join(f"'{k}', {k}" for k in keys) + ')'
+        sql = (f'''
+               WITH pending AS (SELECT {item_key} AS item_key, to_jsonb(u) AS item FROM update_{table_name} AS u), 
+               pruned AS (DELETE FROM _work_queue WHERE queue_name = '{table_name}' 
+               AND (leased_until IS NULL OR leased_until < now()) 
+               AND item_key NOT IN (SELECT item_key FROM pending)) 
+               INSERT INTO _work_queue (queue_name, item_key, item) 
+               SELECT '{table_name}', item_key, item FROM pending 
+               ON CONFLICT (queue_name, item_key) DO NOTHING 
+               ;
+               ''')
+        filled_rows = self.execute(sql)
+        print(f'\t...queued {filled_rows} new {table_name} items')
+
+    def fill_queues(self):
+        # the full discovery pass, for when the backlog counts need to catch up with the data
+        for uv in SQLer.updates:
+            if 'keys' in uv:
+                self.fill_queue(uv['name'].removeprefix('update_'))
+
+    def recount_queues(self):
+        # start the trigger-kept counts over from the queue itself
+        sqls = ['LOCK TABLE _work_queue IN SHARE MODE;',
+                'DELETE FROM _queue_counts;',
+                (f'''
+                 INSERT INTO _queue_counts (queue_name, failures, queued_rows) 
+                 SELECT queue_name, LEAST(failures, {NEON_QUEUE_MAX_FAILURES}), count(*) FROM _work_queue 
+                 GROUP BY 1, 2 
+                 ;
+                 '''),
+                ]
+        self.execute(sqls)
+
+    def get_update_status(self):
+        # backlog sizes as of each queue's last change, without evaluating the update views
+        # failed rows are still being retried and are part of the remaining rows, parked rows have given up
+        sql = (f'''
+               SELECT queue_name, 
+               COALESCE(sum(queued_rows) FILTER (WHERE failures < {NEON_QUEUE_MAX_FAILURES}), 0) AS remaining_rows, 
+               COALESCE(sum(queued_rows) FILTER (WHERE failures > 0 AND failures < {NEON_QUEUE_MAX_FAILURES}), 0) AS failed_rows, 
+               COALESCE(sum(queued_rows) FILTER (WHERE failures >= {NEON_QUEUE_MAX_FAILURES}), 0) AS parked_rows, 
+               max(counted_at) AS counted_at 
+               FROM _queue_counts GROUP BY queue_name ORDER BY queue_name 
+               ;
+               ''')
+        status_df = self.read_sql(sql)
+        return status_df
+
+    def claim_queue(self, table_name, service_id=None, limit=1000):
+        # lease a batch of work items that no other worker holds
+        wheres = f"AND item_key->>'service_id' = '{service_id}'" if service_id else ''
+        available = (f'''
+                     queue_name = '{table_name}' AND (leased_until IS NULL OR leased_until < now()) 
+                     AND failures < {NEON_QUEUE_MAX_FAILURES} {wheres}
+                     ''')
+        sql = (f'''
+               WITH claimed AS (SELECT queue_name, item_key FROM _work_queue WHERE {available} 
+               ORDER BY failures, enqueued_at LIMIT {limit} FOR UPDATE SKIP LOCKED) 
+               UPDATE _work_queue AS q SET lease_owner = '{self.get_queue_owner()}', 
+               leased_until = now() + interval '{NEON_QUEUE_LEASE} seconds' 
+               FROM claimed WHERE q.queue_name = claimed.queue_name AND q.item_key = claimed.item_key 
+               RETURNING q.item 
+               ;
+               ''')
+
+        with self.session():
+            if not self.read_sql(f'SELECT EXISTS (SELECT 1 FROM _work_queue WHERE {available}) AS available;')['available'].iloc[0]:
+                self.fill_queue(table_name)
+            claimed_df = self.read_sql(sql)
+            self.execute() # commit the leases
+
+        items_df = DataFrame(claimed_df['item'].tolist())
+        for column in [c for c in items_df.columns if c.endswith('_date')]:
+            items_df[column] = to_datetime(items_df[column]).dt.date
+        return items_df
+
+    def release_queue(self, table_name, items_df, done_df=None):
+        # items found in the results are finished, the rest count a failure and go back on the queue
+        keys = self.get_queue_keys(table_name)
+        done = set()
+        if (done_df is not None) and (not done_df.empty):
+            shared = [k for k in keys if k in done_df.columns]
+            values = [c for c in done_df.columns if c not in keys]
+            found_df = done_df.dropna(how='all', subset=values) if values else done_df
+            done = set(map(tuple, found_df[shared].values))
+        else:
+            shared = keys
+
+        done_keys = []
+        failed_keys = []
+        for _, item_s in items_df.iterrows():
+            item_key = self.dbify({k: item_s[k] for k in keys})
+            (done_keys if tuple(item_s[shared]) in done else failed_keys).append(item_key)
+
+        sqls = []
+        if done_keys:
+            sqls.append(f'''
+                        DELETE FROM _work_queue WHERE queue_name = '{table_name}' 
+                        AND item_key IN ({", ".join(done_keys)}) 
+                        ;
+                        ''')
+        if failed_keys:
+            sqls.append(f'''
+                        UPDATE _work_queue SET failures = failures + 1, lease_owner = NULL, leased_until = NULL 
+                        WHERE queue_name = '{table_name}' AND lease_owner = '{self.get_queue_owner()}' 
+                        AND item_key IN ({", ".join(failed_keys)}) 
+                        ;
+                        ''')
+        self.execute(sqls)
+        print(f'\t...released {len(done_keys)} finished and {len(failed_keys)} failed {table_name} items')
+
     ''' get data for pull '''
     def get_service_id(self, service_name):
         sql = f'SELECT service_id FROM services WHERE service_name = {self.dbify(service_name)};'
@@ -511,23 +1270,23 @@ class Neon:
         return start_date, end_date
     
     def get_tracks_to_update(self, service_id):
-        tracks_df = self.get_table_to_update('tracks', service_id=service_id)
+        tracks_df = self.claim_queue('tracks', service_id=service_id)
         return tracks_df
 
     def get_recordings_to_update(self):
-        tracks_df = self.get_table_to_update('recordings')#, limit=50)
+        tracks_df = self.claim_queue('recordings')
         return tracks_df
 
     def get_works_to_update(self):
-        tracks_df = self.get_table_to_update('works')#, limit=50)
+        tracks_df = self.claim_queue('works')
         return tracks_df
 
     def get_artists_to_update(self, service_id):
-        artists_df = self.get_table_to_update('artists', service_id=service_id)
+        artists_df = self.claim_queue('artists', service_id=service_id)
         return artists_df
 
     def get_soundtracks_to_update(self, service_id):
-        tracks_df = self.get_table_to_update('soundtracks', service_id=service_id)
+        tracks_df = self.claim_queue('soundtracks', service_id=service_id)
         return tracks_df
 
     def get_compilations_to_update(self):
@@ -535,11 +1294,11 @@ class Neon:
         return tracks_df
     
     def get_upcs_to_update(self):
-        albums_df = self.get_table_to_update('upcs')
+        albums_df = self.claim_queue('upcs')
         return albums_df
         
     def get_barcodes_to_update(self):
-        tracks_df = self.get_table_to_update('barcodes')
+        tracks_df = self.claim_queue('barcodes')
         return tracks_df
     
     def get_billboard_to_update(self):
@@ -575,7 +1334,27 @@ class Neon:
     def get_user_albums(self, user_id, min_ranking=None, min_rating=None, categories=None,
                         min_duration=None, max_duration=None, explicit=None, release_year=None, release_decade=None,
                         min_chart_peak=None, min_stars=None):
-        wheres = []
+        wheres = self.get_user_albums_wheres(user_id, min_ranking=min_ranking, min_rating=min_rating, categories=categories,
+                                             min_duration=min_duration, max_duration=max_duration, explicit=explicit,
+                                             release_year=release_year, release_decade=release_decade,
+                                             min_chart_peak=min_chart_peak, min_stars=min_stars)
+        sql = f'SELECT * FROM user_albums WHERE {wheres};'
+        albums_df = self.read_sql(sql)
+        return albums_df
+
+    def get_user_album(self, user_id, source_id, album_uri):
+        sql = (f'''
+               SELECT source_id, album_uri, artist_names, album_name, service_name, track_list FROM user_albums 
+               WHERE user_id = {self.dbify(user_id)} AND source_id = {self.dbify(source_id)} AND album_uri = {self.dbify(album_uri)} 
+               ;
+               ''')
+        albums_df = self.read_sql(sql)
+        return albums_df.iloc[0] if len(albums_df) else None
+
+    def get_user_albums_wheres(self, user_id, min_ranking=None, min_rating=None, categories=None,
+                               min_duration=None, max_duration=None, explicit=None, release_year=None, release_decade=None,
+                               min_chart_peak=None, min_stars=None):
+        wheres = [f'user_id = {user_id}']
         if min_ranking:
             wheres.append(f'ranking <= {min_ranking}')
         if min_rating:
@@ -600,12 +1379,48 @@ class Neon:
             wheres.append(f'peak_position <= {min_chart_peak}')
         if min_stars:
             wheres.append(f'stars >= {min_stars}')
-            
-        sql = f'SELECT * FROM user_albums WHERE user_id = {user_id}{" AND ".join(wheres)}'
+        return ' AND '.join(wheres)
+    
+    def get_random_album(self, user_id, weight=None, **kwargs):
+        # pick one row in the database, weighted picks use exponential keys so a higher weight comes up more often
+        wheres = self.get_user_albums_wheres(user_id, **kwargs)
+        orders = f'-ln(1.0 - random()) / GREATEST(COALESCE({weight}, 0), 0.01)' if weight else 'random()'
+        sql = (f'''
+               SELECT source_id, album_uri, artist_names, album_name, service_name, track_list 
+               FROM user_albums WHERE {wheres} 
+               ORDER BY {orders} LIMIT 1 
+               ;
+               ''')
+        album_s = self.read_sql(sql).squeeze()
+        return album_s
+
+    def get_user_albums_since(self, user_id, watermark=None):
+        wheres = f" AND refreshed_at > '{watermark}'" if watermark else ''
+        sql = f'SELECT * FROM user_albums WHERE user_id = {user_id}{wheres};'
         albums_df = self.read_sql(sql)
         return albums_df
-    
-    def get_random_album(self, user_id, **kwargs):
-        albums_df = self.get_user_albums(user_id, **kwargs)
-        album_s = albums_df.sample(1).squeeze()
-        return album_s
\ No newline at end of file
+
+    def get_user_album_keys(self, user_id):
+        sql = f'SELECT source_id, album_uri FROM user_albums WHERE user_id = {user_id};'
+        keys_df = self.read_sql(sql)
+        return keys_df
+
+    def update_album_plays(self, user_id, plays_df):
+        # plays arrive as ages so the time is set on the database clock
+        values = ', '.join(f"({self.dbify(user_id)}, {self.dbify(s)}, {self.dbify(a)}, now() - make_interval(secs => {float(p)}))"
+                           for s, a, p in plays_df[['source_id', 'album_uri', 'seconds_ago']].values)
+        sql = (f'''
+               INSERT INTO plays (user_id, source_id, album_uri, played_at) 
+               VALUES {values} 
+               ;
+               ''')
+        self.execute(sql)
+
+    def get_last_plays(self, user_id):
+        sql = (f'''
+               SELECT source_id, album_uri, EXTRACT(EPOCH FROM now() - max(played_at)) AS seconds_ago 
+               FROM plays WHERE user_id = {self.dbify(user_id)} GROUP BY source_id, album_uri 
+               ;
+               ''')
+        plays_df = self.read_sql(sql)
+        return plays_df
\ No newline at end of file
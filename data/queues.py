@@ -0,0 +1,153 @@
+''' Background reads and writes for interactive sessions '''
+
+import json
+import time
+from os import makedirs, remove
+from os.path import dirname, exists, realpath
+from queue import Queue, Empty, Full
+from threading import Thread, Event
+
+from ..common.structure import REPLICA_FOLDER
+
+class Prefetcher:
+    depth = 3
+    backoff = 0.1
+    max_backoff = 2
+    max_repeats = 10
+
+    def __init__(self, fetch, depth=None, key=None):
+        # keep the next few results ready so the user never waits on a query
+        self.fetch = fetch
+        self.key = key
+        self.ready = Queue(maxsize=depth or Prefetcher.depth)
+        self.stopping = Event()
+        self.thread = Thread(target=self.fill, daemon=True)
+        self.thread.start()
+
+    def fill(self):
+        recent = []
+        repeats = 0
+        while not self.stopping.is_set():
+            try:
+                item = self.fetch()
+            except Exception as e:
+                print(f'...prefetch failed due to {e}.')
+                item = None
+
+            if self.key and (item is not None) and (not item.empty):
+                # skip anything already waiting in line, backing off while only those come back
+                key = self.key(item)
+                if key in recent:
+                    repeats += 1
+                    if repeats < self.max_repeats:
+                        time.sleep(min(self.backoff * 2 ** repeats, self.max_backoff))
+                        continue
+                    # nothing new left, let the consumer stop
+                    item = None
+                else:
+                    repeats = 0
+                    recent = (recent + [key])[-self.ready.maxsize:]
+
+            while not self.stopping.is_set():
+                try:
+                    self.ready.put(item, timeout=0.5)
+                    break
+                except Full:
+                    pass
+
+            if (item is None) or item.empty:
+                # nothing left to fetch
+                break
+
+    def get(self):
+        return self.ready.get()
+
+    def stop(self):
+        self.stopping.set()
+
+
+class WriteBehind:
+    batch_size = 10
+    interval = 2
+    max_failures = 3
+    parked_file = 'parked_writes.jsonl'
+
+    def __init__(self, neon, batch_size=None, interval=None):
+        # send writes in batches from a background thread instead of between keypresses
+        self.neon = neon
+        self.batch_size = batch_size or WriteBehind.batch_size
+        self.interval = interval or WriteBehind.interval
+        folder = dirname(dirname(realpath(__file__))) + '/' + REPLICA_FOLDER
+        makedirs(folder, exist_ok=True)
+        self.parked_path = f'{folder}/{WriteBehind.parked_file}'
+        self.writes = Queue()
+        # each write is the list of statements from one put, they succeed or fail together
+        self.pending = []
+        self.failures = 0
+        self.parked = 0
+        self.closing = Event()
+        self.unpark()
+        self.thread = Thread(target=self.drain, daemon=True)
+        self.thread.start()
+
+    def put(self, sqls):
+        self.writes.put(sqls if isinstance(sqls, list) else [sqls])
+
+    def drain(self):
+        started = time.time()
+        while not (self.closing.is_set() and self.writes.empty()):
+            try:
+                self.pending.append(self.writes.get(timeout=self.interval))
+            except Empty:
+                pass
+            if (len(self.pending) >= self.batch_size) or (time.time() - started >= self.interval) or self.closing.is_set():
+                self.flush()
+                started = time.time()
+        self.flush()
+        if self.pending:
+            self.flush_each()
+
+    def flush(self):
+        if self.pending:
+            try:
+                # one round trip and one transaction for the whole batch
+                self.neon.execute(' '.join(sql for write in self.pending for sql in write))
+                self.pending = []
+                self.failures = 0
+            except Exception as e:
+                print(f'...write of {len(self.pending)} results failed due to {e}.')
+                self.failures += 1
+                if self.failures >= self.max_failures:
+                    self.flush_each()
+
+    def flush_each(self):
+        # send the writes one at a time so only the ones that fail on their own are set aside
+        for write in self.pending:
+            try:
+                self.neon.execute(' '.join(write))
+            except Exception as e:
+                print(f'...parking a result that failed on its own due to {e}.')
+                self.park(write)
+        self.pending = []
+        self.failures = 0
+
+    def park(self, write):
+        # keep it on disk for the next session instead of dropping the user's input
+        with open(self.parked_path, 'a') as f:
+            f.write(json.dumps(write) + '\n')
+        self.parked += 1
+
+    def unpark(self):
+        # try writes parked by earlier sessions again
+        if exists(self.parked_path):
+            with open(self.parked_path) as f:
+                writes = [json.loads(line) for line in f if line.strip()]
+            remove(self.parked_path)
+            for write in writes:
+                self.writes.put(write)
+
+    def close(self):
+        self.closing.set()
+        self.thread.join()
+        if self.parked:
+            print(f'...{self.parked} results could not be written, they are kept in {self.parked_path} for the next session.')
@@ -0,0 +1,75 @@
+''' Album ratings from head-to-head comparisons '''
+
+import random
+
+from pandas import DataFrame
+
+class Elo:
+    base = 1500
+    k = 32
+    scale = 400
+
+    def get_expected(score, opponent_score):
+        return 1 / (1 + 10 ** ((opponent_score - score) / Elo.scale))
+
+    def get_sql(score, opponent_score, won):
+        # the same update as get_update, for use inside a statement
+        return f'{score} + {Elo.k} * ({won} - 1 / (1 + 10 ^ (({opponent_score} - {score}) / {Elo.scale})))'
+
+    def get_update(score, opponent_score, won):
+        return score + Elo.k * (won - Elo.get_expected(score, opponent_score))
+
+    def replay(battles_df, categories):
+        # rebuild ratings from scratch by playing battles back in the order they were decided
+        ratings = {}
+        for _, battle_s in battles_df.sort_values('decided_at').iterrows():
+            user_id = battle_s['user_id']
+            winner = (user_id, battle_s['winner_source_id'], battle_s['winner_uri'])
+            loser = (user_id, battle_s['loser_source_id'], battle_s['loser_uri'])
+            rating_w = ratings.setdefault(winner, {'score': Elo.base, 'games': 0, 'wins': 0})
+            rating_l = ratings.setdefault(loser, {'score': Elo.base, 'games': 0, 'wins': 0})
+
+            score_w, score_l = rating_w['score'], rating_l['score']
+            rating_w['score'] = Elo.get_update(score_w, score_l, 1)
+            rating_l['score'] = Elo.get_update(score_l, score_w, 0)
+            rating_w['games'] += 1
+            rating_l['games'] += 1
+            rating_w['wins'] += 1
+
+        ratings_df = DataFrame([{'user_id': user_id, 'source_id': source_id, 'album_uri': album_uri,
+                                 'category': categories.get((source_id, album_uri)), **rating}
+                                for (user_id, source_id, album_uri), rating in ratings.items()],
+                               columns=['user_id', 'source_id', 'album_uri', 'category', 'score', 'games', 'wins'])
+        return ratings_df
+
+class Pairer:
+    strategies = ['random', 'informative']
+    tries = 8
+
+    def get_information(score_a, score_b, games_a, games_b):
+        # close matches between albums with few games tell the most about the order
+        expected = Elo.get_expected(score_a, score_b)
+        return expected * (1 - expected) * (1 / (games_a + 1) + 1 / (games_b + 1))
+
+    def get_sql(score_a, score_b, games_a, games_b):
+        # the same measure as get_information, for use inside a statement
+        expected = f'(1 / (1 + 10 ^ (({score_b} - {score_a}) / {Elo.scale})))'
+        return f'{expected} * (1 - {expected}) * (1.0 / ({games_a} + 1) + 1.0 / ({games_b} + 1))'
+
+    def pick(scores, games, played, strategy='random', tries=None, rng=None):
+        # mirror of the database draw, for simulations: returns the indices of two albums
+        tries = tries or Pairer.tries
+        rng = rng or random
+        num_albums = len(scores)
+        first_tries = tries if strategy == 'informative' else 1
+        first_draws = [rng.randrange(num_albums) for _ in range(first_tries)]
+        first = min(first_draws, key=lambda i: games[i]) if strategy == 'informative' else first_draws[0]
+
+        second_draws = [(first + 1 + rng.randrange(num_albums - 1)) % num_albums for _ in range(tries)]
+        def get_priority(n_j):
+            n, j = n_j
+            repeat = frozenset([first, j]) in played
+            information = Pairer.get_information(scores[first], scores[j], games[first], games[j]) if strategy == 'informative' else 0
+            return (repeat, -information, n)
+        _, second = min(enumerate(second_draws), key=get_priority)
+        return first, second
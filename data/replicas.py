@@ -0,0 +1,147 @@
+''' Local copy of user albums for playing without the database '''
+
+import json
+import sqlite3
+import time
+from datetime import date, datetime
+from os import makedirs
+from os.path import dirname, realpath
+from threading import Thread
+
+from pandas import DataFrame, read_sql, isna
+
+from ..common.structure import REPLICA_FOLDER
+from .sqls import SQLer
+
+class Replica:
+    json_columns = ['release_decades', 'track_list']
+    date_columns = ['release_date']
+
+    def __init__(self, filename='replica'):
+        folder = dirname(dirname(realpath(__file__))) + '/' + REPLICA_FOLDER
+        makedirs(folder, exist_ok=True)
+        self.path = f'{folder}/{filename}.sqlite'
+        view = next(v for v in SQLer.materialized if v['name'] == 'user_albums')
+        self.keys = view['keys']
+        self.columns = view['keys'] + view['columns'] + ['refreshed_at']
+        self.create_tables()
+
+    def connect(self):
+        # a connection per call so background syncs and reads can run on different threads
+        return sqlite3.connect(self.path, timeout=30)
+
+    def create_tables(self):
+        with self.connect() as connection:
+            connection.execute(f'CREATE TABLE IF NOT EXISTS user_albums ({", ".join(self.columns)}, '
+                               f'PRIMARY KEY ({", ".join(self.keys)}));')
+            connection.execute('CREATE TABLE IF NOT EXISTS _syncs (user_id PRIMARY KEY, watermark, synced_at);')
+            # play times are kept on the local clock, plays waiting to be sent and the latest known play of each album
+            connection.execute('CREATE TABLE IF NOT EXISTS _plays (user_id, source_id, album_uri, played_at);')
+            connection.execute('CREATE TABLE IF NOT EXISTS _last_plays (user_id, source_id, album_uri, played_at, '
+                               'PRIMARY KEY (user_id, source_id, album_uri));')
+
+    def get_watermark(self, user_id):
+        with self.connect() as connection:
+            row = connection.execute('SELECT watermark FROM _syncs WHERE user_id = ?;', (int(user_id),)).fetchone()
+        return row[0] if row else None
+
+    def has_albums(self, user_id):
+        with self.connect() as connection:
+            row = connection.execute('SELECT 1 FROM user_albums WHERE user_id = ? LIMIT 1;', (int(user_id),)).fetchone()
+        return row is not None
+
+    def localize(self, value):
+        if isinstance(value, (list, dict)):
+            value = json.dumps(value)
+        elif (value is None) or isna(value):
+            value = None
+        elif isinstance(value, date):
+            value = value.isoformat()
+        elif hasattr(value, 'item'):
+            value = value.item()
+        return value
+
+    def sync(self, neon, user_id):
+        # pull only rows refreshed since the last sync, then drop rows that no longer exist upstream
+        watermark = self.get_watermark(user_id)
+        changes_df = neon.get_user_albums_since(user_id, watermark)
+        keys_df = neon.get_user_album_keys(user_id)
+
+        rows = [[self.localize(v) for v in r] for r in changes_df[self.columns].values]
+        marks = ', '.join('?' for _ in self.columns)
+        with self.connect() as connection:
+            connection.executemany(f'INSERT OR REPLACE INTO user_albums ({", ".join(self.columns)}) VALUES ({marks});', rows)
+            connection.execute('CREATE TEMP TABLE _keys (source_id, album_uri);')
+            connection.executemany('INSERT INTO _keys VALUES (?, ?);', [[self.localize(v) for v in r] for r in keys_df.values])
+            deleted = connection.execute('DELETE FROM user_albums WHERE user_id = ? AND (source_id, album_uri) NOT IN '
+                                         '(SELECT source_id, album_uri FROM _keys);', (int(user_id),)).rowcount
+            if len(changes_df):
+                watermark = self.localize(changes_df['refreshed_at'].max())
+            connection.execute("INSERT OR REPLACE INTO _syncs VALUES (?, ?, datetime('now'));", (int(user_id), watermark))
+
+        print(f'\tsynced replica for user {user_id}: {len(changes_df)} changed and {deleted} removed albums')
+        self.sync_plays(neon, user_id)
+
+    def record_play(self, user_id, source_id, album_uri):
+        with self.connect() as connection:
+            connection.execute('INSERT INTO _plays VALUES (?, ?, ?, ?);', (int(user_id), int(source_id), album_uri, time.time()))
+
+    def get_last_played(self, user_id):
+        with self.connect() as connection:
+            rows = connection.execute('SELECT source_id, album_uri, max(played_at) FROM '
+                                      '(SELECT source_id, album_uri, played_at FROM _plays WHERE user_id = ? '
+                                      'UNION ALL SELECT source_id, album_uri, played_at FROM _last_plays WHERE user_id = ?) '
+                                      'GROUP BY source_id, album_uri;', (int(user_id), int(user_id))).fetchall()
+        return {(s, a): p for s, a, p in rows}
+
+    def sync_plays(self, neon, user_id):
+        # send the plays made since the last sync, then take the latest play of every album back
+        with self.connect() as connection:
+            rows = connection.execute('SELECT rowid, source_id, album_uri, played_at FROM _plays WHERE user_id = ?;',
+                                      (int(user_id),)).fetchall()
+        if rows:
+            now = time.time()
+            plays_df = DataFrame([[s, a, now - p] for _, s, a, p in rows], columns=['source_id', 'album_uri', 'seconds_ago'])
+            neon.update_album_plays(user_id, plays_df)
+            with self.connect() as connection:
+                connection.executemany('DELETE FROM _plays WHERE rowid = ?;', [(r[0],) for r in rows])
+
+        plays_df = neon.get_last_plays(user_id)
+        now = time.time()
+        with self.connect() as connection:
+            connection.executemany('INSERT OR REPLACE INTO _last_plays VALUES (?, ?, ?, ?);',
+                                   [(int(user_id), self.localize(s), a, now - float(p)) for s, a, p in plays_df.values])
+        print(f'\tsynced {len(rows)} plays for user {user_id}')
+
+    def sync_in_background(self, neon, user_id, on_done=None):
+        def run():
+            try:
+                self.sync(neon, user_id)
+                if on_done:
+                    on_done()
+            except Exception as e:
+                print(f'...replica sync failed due to {e}.')
+
+        thread = Thread(target=run, daemon=True)
+        thread.start()
+        return thread
+
+    def get_user_albums(self, user_id):
+        with self.connect() as connection:
+            albums_df = read_sql('SELECT * FROM user_albums WHERE user_id = ?;', connection, params=(int(user_id),))
+        return self.delocalize(albums_df)
+
+    def get_user_album(self, user_id, source_id, album_uri):
+        with self.connect() as connection:
+            albums_df = read_sql('SELECT * FROM user_albums WHERE user_id = ? AND source_id = ? AND album_uri = ?;', connection,
+                                 params=(int(user_id), int(source_id), album_uri))
+        return self.delocalize(albums_df).iloc[0] if len(albums_df) else None
+
+    def delocalize(self, albums_df):
+        for column in self.json_columns:
+            albums_df[column] = albums_df[column].apply(lambda v: json.loads(v) if isinstance(v, str) else v)
+        for column in self.date_columns:
+            # timestamps are stored with their time, which date.fromisoformat rejects
+            albums_df[column] = albums_df[column].apply(lambda v: datetime.fromisoformat(v).date() if isinstance(v, str) else None)
+        albums_df['explicit'] = albums_df['explicit'].astype(bool)
+        return albums_df
@@ -0,0 +1,83 @@
+''' In-memory copy of a user's library '''
+
+import random
+
+from numpy import array, zeros, full, isin, flatnonzero, int8, int16, uint32, float32
+from pandas import isna, Categorical
+
+class Snapshot:
+    missing_rank = 32767
+    first_decade = 1900
+    columns = ['source_id', 'album_uri', 'artist_names', 'album_name', 'service_name']
+
+    def __init__(self, library, user_id):
+        # load user_albums once from the replica or the database and keep each filterable column as a compact array
+        self.library = library
+        self.user_id = user_id
+        albums_df = library.get_user_albums(user_id).reset_index(drop=True)
+
+        self.size = len(albums_df)
+        self.ranking = albums_df['ranking'].fillna(self.missing_rank).to_numpy(int16)
+        self.rating = albums_df['rating'].fillna(-1).to_numpy(int8)
+        categories = Categorical(albums_df['category'])
+        self.category_names = list(categories.categories)
+        self.category = categories.codes.astype(int8)
+        self.play_duration = albums_df['play_duration'].astype(float).to_numpy(float32)
+        self.explicit = albums_df['explicit'].fillna(False).to_numpy(bool)
+        self.release_year = array([d.year if not isna(d) else 0 for d in albums_df['release_date']], dtype=int16)
+        self.peak_position = albums_df['peak_position'].fillna(self.missing_rank).to_numpy(int16)
+        self.stars = albums_df['stars'].astype(float).to_numpy(float32)
+
+        # one bit per decade an album belongs to
+        self.decades = zeros(self.size, dtype=uint32)
+        for i, decades in enumerate(albums_df['release_decades']):
+            if not isinstance(decades, list):
+                # same fallback to the release date as the database
+                decades = [self.release_year[i] // 10 * 10] if self.release_year[i] else []
+            for decade in decades:
+                self.decades[i] |= self.get_decade_bit(decade)
+
+        # track lists and the rest are looked up when an album is picked
+        self.albums_df = albums_df[self.columns].copy()
+
+    def get_decade_bit(self, decade):
+        return uint32(1 << min(max((int(decade) - self.first_decade) // 10, 0), 31))
+
+    def get_mask(self, min_ranking=None, min_rating=None, categories=None,
+                 min_duration=None, max_duration=None, explicit=None, release_year=None, release_decade=None,
+                 min_chart_peak=None, min_stars=None):
+        # same filters and NULL handling as get_user_albums, as boolean masks
+        mask = full(self.size, True)
+        if min_ranking:
+            mask &= self.ranking <= min_ranking
+        if min_rating:
+            mask &= self.rating >= min_rating
+        if categories:
+            codes = [self.category_names.index(c) for c in categories if c in self.category_names]
+            mask &= isin(self.category, array(codes, dtype=int8))
+        if min_duration:
+            mask &= self.play_duration >= min_duration
+        if max_duration:
+            mask &= self.play_duration <= max_duration
+        if release_year:
+            mask &= self.release_year == release_year
+        elif release_decade:
+            mask &= (self.decades & self.get_decade_bit(release_decade)) > 0
+        if explicit is not None:
+            mask &= self.explicit == explicit
+        if min_chart_peak:
+            mask &= self.peak_position <= min_chart_peak
+        if min_stars:
+            mask &= self.stars >= min_stars
+        return mask
+
+    def get_albums(self, **filters):
+        return self.albums_df[self.get_mask(**filters)]
+
+    def get_album(self, i):
+        source_id, album_uri = self.albums_df.iloc[i][['source_id', 'album_uri']]
+        return self.library.get_user_album(self.user_id, source_id, album_uri)
+
+    def get_random_album(self, **filters):
+        indices = flatnonzero(self.get_mask(**filters))
+        return self.get_album(random.choice(indices)) if len(indices) else None
@@ -1,6 +1,72 @@
 ''' Database tables and views '''
 
+from hashlib import sha256
+
+from ..common.structure import NEON_QUEUE_MAX_FAILURES, NEON_SUMMARY_RANKS
+
 class SQLer:
+    functions = [{'name': 'match_artists',
+                  'sql': ('''
+                          (names text) RETURNS text LANGUAGE sql IMMUTABLE AS $$ 
+                          SELECT CASE WHEN names ~* '\\s+(and|&|/)\\s+' 
+                          THEN regexp_replace(regexp_replace(lower(names), 
+                          '\\s+&\\s+|\\s+and\\s+|\\s+/\\s+', '; ', 'g'), ',\\s*', '; ', 'g') 
+                          ELSE lower(names) END 
+                          $$
+                          '''),
+                  },
+                 {'name': 'match_title',
+                  'sql': ('''
+                          (title text) RETURNS text LANGUAGE sql IMMUTABLE AS $$ 
+                          SELECT regexp_replace(lower(title), '\\s+/\\s+', '/', 'g') 
+                          $$
+                          '''),
+                  },
+                 {'name': 'count_queue',
+                  'sql': ('''
+                          () RETURNS trigger LANGUAGE plpgsql AS $$ BEGIN 
+                          IF TG_OP = 'INSERT' THEN 
+                          INSERT INTO _queue_counts (queue_name, failures, queued_rows) 
+                          SELECT queue_name, LEAST(failures, TG_ARGV[0]::integer), count(*) FROM new_rows 
+                          GROUP BY 1, 2 
+                          ON CONFLICT (queue_name, failures) DO UPDATE SET 
+                          queued_rows = _queue_counts.queued_rows + EXCLUDED.queued_rows, counted_at = now(); 
+                          ELSIF TG_OP = 'DELETE' THEN 
+                          INSERT INTO _queue_counts (queue_name, failures, queued_rows) 
+                          SELECT queue_name, LEAST(failures, TG_ARGV[0]::integer), -count(*) FROM old_rows 
+                          GROUP BY 1, 2 
+                          ON CONFLICT (queue_name, failures) DO UPDATE SET 
+                          queued_rows = _queue_counts.queued_rows + EXCLUDED.queued_rows, counted_at = now(); 
+                          ELSE 
+                          INSERT INTO _queue_counts (queue_name, failures, queued_rows) 
+                          SELECT queue_name, failures, sum(change) FROM 
+                          (SELECT queue_name, LEAST(failures, TG_ARGV[0]::integer) AS failures, 1 AS change FROM new_rows 
+                          UNION ALL SELECT queue_name, LEAST(failures, TG_ARGV[0]::integer), -1 AS change FROM old_rows) AS changes 
+                          GROUP BY queue_name, failures HAVING sum(change) <> 0 
+                          ON CONFLICT (queue_name, failures) DO UPDATE SET 
+                          queued_rows = _queue_counts.queued_rows + EXCLUDED.queued_rows, counted_at = now(); 
+                          END IF; 
+                          RETURN NULL; 
+                          END $$
+                          '''),
+                  },
+                 ]
+
+    # parked items, at or past the failure limit, share one count per queue at the limit
+    triggers = [{'name': '_work_queue_inserts',
+                 'sql': ('AFTER INSERT ON _work_queue REFERENCING NEW TABLE AS new_rows '
+                         f'FOR EACH STATEMENT EXECUTE FUNCTION count_queue({NEON_QUEUE_MAX_FAILURES})'),
+                 },
+                {'name': '_work_queue_updates',
+                 'sql': ('AFTER UPDATE ON _work_queue REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows '
+                         f'FOR EACH STATEMENT EXECUTE FUNCTION count_queue({NEON_QUEUE_MAX_FAILURES})'),
+                 },
+                {'name': '_work_queue_deletes',
+                 'sql': ('AFTER DELETE ON _work_queue REFERENCING OLD TABLE AS old_rows '
+                         f'FOR EACH STATEMENT EXECUTE FUNCTION count_queue({NEON_QUEUE_MAX_FAILURES})'),
+                 },
+                ]
+
     tables = [{'name': 'services',
                'sql': ('''
                        service_id serial,
@@ -58,6 +124,7 @@ class SQLer:
                        PRIMARY KEY (source_id, album_uri),
                        FOREIGN KEY (source_id) REFERENCES sources (source_id)
                        '''),
+               'indexes': [['album_name']],
                },
               {'name': 'ownerships',
                'sql': ('''
@@ -66,13 +133,53 @@ class SQLer:
                        album_uri varchar,
                        like_date timestamp,
                        rating integer,
-                       wins jsonb,
-                       losses json,
                        PRIMARY KEY (user_id, source_id, album_uri),
                        FOREIGN KEY (user_id) REFERENCES profiles (user_id),
                        FOREIGN KEY (source_id, album_uri) REFERENCES albums (source_id, album_uri)
                        '''),
                },
+              {'name': 'battles',
+               'sql': ('''
+                       user_id integer,
+                       winner_source_id integer,
+                       winner_uri varchar,
+                       loser_source_id integer,
+                       loser_uri varchar,
+                       decided_at timestamp DEFAULT now(),
+                       PRIMARY KEY (user_id, winner_source_id, winner_uri, loser_source_id, loser_uri),
+                       FOREIGN KEY (user_id, winner_source_id, winner_uri) REFERENCES ownerships (user_id, source_id, album_uri) ON DELETE CASCADE,
+                       FOREIGN KEY (user_id, loser_source_id, loser_uri) REFERENCES ownerships (user_id, source_id, album_uri) ON DELETE CASCADE
+                       '''),
+               'indexes': [['user_id', 'loser_source_id', 'loser_uri']],
+               },
+              {'name': 'album_ratings',
+               'sql': ('''
+                       user_id integer,
+                       source_id integer,
+                       album_uri varchar,
+                       category varchar,
+                       score double precision,
+                       games integer,
+                       wins integer,
+                       confidence double precision GENERATED ALWAYS AS 
+                       ((wins::float / games + 1.9208 / games - 1.96 * sqrt(wins::float * (games - wins) / games + 0.9604) / games) 
+                       / (1 + 3.8416 / games)) STORED,
+                       rated_at timestamp DEFAULT now(),
+                       PRIMARY KEY (user_id, source_id, album_uri),
+                       FOREIGN KEY (user_id, source_id, album_uri) REFERENCES ownerships (user_id, source_id, album_uri) ON DELETE CASCADE
+                       '''),
+               'indexes': [['user_id', 'category', 'score DESC']],
+               },
+              {'name': 'plays',
+               'sql': ('''
+                       user_id integer,
+                       source_id integer,
+                       album_uri varchar,
+                       played_at timestamp DEFAULT now(),
+                       PRIMARY KEY (user_id, source_id, album_uri, played_at),
+                       FOREIGN KEY (user_id, source_id, album_uri) REFERENCES ownerships (user_id, source_id, album_uri) ON DELETE CASCADE
+                       '''),
+               },
               {'name': 'tracks',
                'sql': ('''
                        serivce_id integer,
@@ -86,6 +193,40 @@ class SQLer:
                        FOREIGN KEY (service_id) REFERENCES services (service_id)
                        '''),
                },
+              {'name': 'track_titles',
+               'sql': ('''
+                       service_id integer,
+                       track_uri varchar,
+                       title_stem varchar,
+                       good_repeat boolean,
+                       bad_repeat boolean,
+                       good_short boolean,
+                       PRIMARY KEY (service_id, track_uri),
+                       FOREIGN KEY (service_id, track_uri) REFERENCES tracks (service_id, track_uri) ON DELETE CASCADE
+                       '''),
+               'indexes': [['title_stem']],
+               },
+              {'name': 'album_tracks',
+               'sql': ('''
+                       source_id integer,
+                       album_uri varchar,
+                       track_num integer,
+                       track_uri varchar,
+                       PRIMARY KEY (source_id, album_uri, track_num),
+                       FOREIGN KEY (source_id, album_uri) REFERENCES albums (source_id, album_uri) ON DELETE CASCADE
+                       '''),
+               'indexes': [['source_id', 'track_uri'], ['track_uri']],
+               },
+              {'name': 'album_categories',
+               'sql': ('''
+                       source_id integer,
+                       album_uri varchar,
+                       category varchar,
+                       PRIMARY KEY (source_id, album_uri),
+                       FOREIGN KEY (source_id, album_uri) REFERENCES albums (source_id, album_uri) ON DELETE CASCADE
+                       '''),
+               'indexes': [['category']],
+               },
               {'name': 'series',
                'sql': ('''
                        user_id integer,
@@ -144,8 +285,11 @@ class SQLer:
                        album_title varchar,
                        credit_names varchar,
                        peak_position integer,
-                       PRIMARY KEEY (album_tile, credit_names)
+                       title_key varchar GENERATED ALWAYS AS (match_title(album_title)) STORED,
+                       artist_key varchar GENERATED ALWAYS AS (match_artists(credit_names)) STORED,
+                       PRIMARY KEY (album_title, credit_names)
                        '''),
+               'indexes': [['title_key', 'artist_key']],
                },
               {'name': 'critics',
                'sql': ('''
@@ -157,6 +301,26 @@ class SQLer:
                        PRIMARY KEY (critic_name, list_year, list_position)
                        ''')
                },
+              {'name': 'critic_matches',
+               'sql': ('''
+                       source_id integer,
+                       album_uri varchar,
+                       critic_name varchar,
+                       list_year integer,
+                       list_position integer,
+                       PRIMARY KEY (critic_name, list_year, list_position, source_id, album_uri),
+                       FOREIGN KEY (source_id, album_uri) REFERENCES albums (source_id, album_uri) ON DELETE CASCADE,
+                       FOREIGN KEY (critic_name, list_year, list_position) REFERENCES critics (critic_name, list_year, list_position) ON DELETE CASCADE
+                       '''),
+               'indexes': [['source_id', 'album_uri']],
+               },
+              {'name': 'keywords',
+               'sql': ('''
+                       keyword varchar,
+                       phrase varchar,
+                       PRIMARY KEY (keyword, phrase)
+                       '''),
+               },
               {'name': '_data_updates',
                'sql': ('''
                        table_name VARCHAR,
@@ -164,6 +328,48 @@ class SQLer:
                        end_date DATE
                        ''')
                },
+              {'name': '_schema_objects',
+               'sql': ('''
+                       object_name varchar,
+                       object_kind varchar,
+                       fingerprint varchar,
+                       deployed_at timestamp DEFAULT now(),
+                       PRIMARY KEY (object_name)
+                       ''')
+               },
+              {'name': '_work_queue',
+               'sql': ('''
+                       queue_name varchar,
+                       item_key jsonb,
+                       item jsonb,
+                       lease_owner varchar,
+                       leased_until timestamp,
+                       failures integer DEFAULT 0,
+                       enqueued_at timestamp DEFAULT now(),
+                       PRIMARY KEY (queue_name, item_key)
+                       '''),
+               'indexes': [['queue_name', 'failures', 'enqueued_at']],
+               },
+              {'name': '_queue_counts',
+               'sql': ('''
+                       queue_name varchar,
+                       failures integer,
+                       queued_rows integer DEFAULT 0,
+                       counted_at timestamp DEFAULT now(),
+                       PRIMARY KEY (queue_name, failures)
+                       '''),
+               },
+              {'name': '_view_deltas',
+               'sql': ('''
+                       delta_id serial,
+                       user_id integer,
+                       source_id integer,
+                       album_uri varchar,
+                       table_name varchar,
+                       noted_at timestamp DEFAULT now(),
+                       PRIMARY KEY (delta_id)
+                       ''')
+               },
               ]
   
     views = [{'name': 'compilations',
@@ -173,8 +379,8 @@ class SQLer:
                       JOIN recordings USING (isrc) JOIN works USING (iswc)), 
                       
                       albums_expanded AS 
-                      (SELECT source_id, album_uri, release_date, arr.track_uri FROM albums, 
-                      jsonb_array_elements_text(track_uris) as arr(track_uri)) 
+                      (SELECT source_id, album_uri, release_date, track_uri FROM albums 
+                      JOIN album_tracks USING (source_id, album_uri)) 
                       
                       SELECT source_id, album_uri, 
                       jsonb_agg(DISTINCT COALESCE(release_year, EXTRACT(YEAR FROM release_date))) AS release_years, 
@@ -184,103 +390,60 @@ class SQLer:
                       JOIN sources USING (source_id) LEFT JOIN full_tracks USING (service_id, track_uri) 
                       GROUP BY source_id, album_uri 
                       '''),
+              'depends': ['albums', 'album_tracks', 'sources', 'tracks', 'recordings', 'works'],
               },
              {'name': 'explicit_albums',
               'sql': ('''
                       SELECT source_id, album_uri, BOOL_OR(explicit) AS explicit 
-                      FROM albums JOIN sources USING (source_id) 
-                      JOIN tracks ON sources.service_id = tracks.service_id AND albums.track_uris ? tracks.track_uri 
+                      FROM album_tracks JOIN sources USING (source_id) 
+                      JOIN tracks USING (service_id, track_uri) 
                       GROUP BY source_id, album_uri HAVING BOOL_OR(explicit) = TRUE 
                       '''),
-              },
-             {'name': 'album_categories',
-              'sql': ('''
-                      WITH regex_soundtrack AS (SELECT '%(' || string_agg(phrase, '|') || ')%' 
-                      AS soundtrack_words FROM keywords WHERE keyword = 'soundtrack'), 
-               
-                      min_score AS (SELECT phrase::numeric AS min_instrumentalness FROM keywords WHERE keyword = 'score_instrumental'), 
-
-                      min_tracks AS (SELECT phrase::numeric AS min_ep_tracks FROM keywords WHERE keyword = 'min_ep_tracks'), 
-               
-                      min_span AS (SELECT phrase::numeric AS min_release_span FROM keywords WHERE keyword = 'min_release_span'), 
-               
-                      mbid_soundtracks AS (SELECT upc, release_type FROM barcodes), 
-
-                      instrumentals AS (SELECT source_id, album_uri, AVG(instrumentalness) AS instrumentalness 
-                      FROM albums JOIN sources USING (source_id) 
-                      JOIN tracks ON sources.service_id = tracks.service_id AND albums.track_uris ? tracks.track_uri 
-                      GROUP BY source_id, album_uri), 
-               
-                      release_years AS (SELECT source_id, album_uri, max(release_year) - min(release_year) AS release_span FROM albums 
-                      JOIN sources USING (source_id) JOIN tracks ON sources.service_id = tracks.service_id AND albums.track_uris ? tracks.track_uri 
-                      JOIN recordings USING (isrc) JOIN works USING (iswc) 
-                      GROUP BY source_id, album_uri) 
-               
-                      SELECT source_id, album_uri, 
-                      CASE WHEN album_type = 'single' AND jsonb_array_length(track_uris) >= min_ep_tracks THEN 'ep' 
-                      WHEN album_type in ('album', 'compilation') THEN 
-                      (CASE WHEN lower(album_name) SIMILAR TO soundtrack_words OR release_type = 'soundtrack' THEN 
-                      (CASE WHEN instrumentalness >= min_instrumentalness THEN 'score' ELSE 'soundtrack' END) 
-                      WHEN release_type = 'compilation' AND release_span >= min_release_span THEN 'compilation' 
-                      WHEN album_type = 'album' THEN 'studio' ELSE album_type END) ELSE album_type END AS category 
-                      FROM albums LEFT JOIN instrumentals USING (source_id, album_uri) 
-                      LEFT JOIN release_years USING (source_id, album_uri) LEFT JOIN mbid_soundtracks USING (upc), 
-                      regex_soundtrack, min_tracks, min_span, min_score 
-                      '''),
+              'depends': ['album_tracks', 'sources', 'tracks'],
               },
              {'name': 'auto_skips',
               'sql': ('''
-                      WITH regex_good_repeat AS (SELECT '%(' || string_agg(phrase, '|') || ')%' 
-                      AS good_repeat FROM keywords WHERE keyword = 'good_repeat'), 
-                      regex_bad_repeat AS (SELECT '%(' || string_agg(phrase, '|') || ')%' 
-                      AS bad_repeat FROM keywords WHERE keyword = 'bad_repeat'), 
-                      regex_good_short AS (SELECT '%(' || string_agg(phrase, '|') || ')%' 
-                      AS good_short FROM keywords WHERE keyword = 'good_short'), 
-                      min_track_time AS (SELECT phrase::numeric AS min_seconds FROM keywords WHERE keyword = 'min_track_time'), 
-                      album_tracks AS (SELECT source_id, album_uri, elem.track_uri, elem.track_num 
-                      FROM albums, jsonb_array_elements_text(track_uris) WITH ORDINALITY AS elem(track_uri, track_num)), 
+                      WITH min_track_duration AS (SELECT phrase::numeric AS min_seconds FROM keywords WHERE keyword = 'min_track_duration'), 
                
-                      album_track_uris AS (SELECT source_id, album_uri, track_uri, track_num, track_name FROM album_tracks 
-                      JOIN sources USING (source_id) JOIN tracks USING (service_id, track_uri)) 
+                      album_titles AS (SELECT source_id, album_uri, track_uri, track_num, title_stem, good_repeat, bad_repeat 
+                      FROM album_tracks JOIN sources USING (source_id) JOIN track_titles USING (service_id, track_uri)) 
                
                       SELECT at1.source_id, at1.album_uri, at1.track_uri 
-                      FROM album_track_uris AS at1 JOIN album_track_uris AS at2 ON 
-                      at1.source_id = at2.source_id AND at1.album_uri = at2.album_uri AND 
-                      at1.track_name LIKE at2.track_name || '%' AND at1.track_num > at2.track_num 
-                      JOIN albums ON at1.source_id = albums.source_id AND at1.album_uri = albums.album_uri, regex_bad_repeat, regex_good_repeat 
-                      WHERE lower(at1.track_name) NOT SIMILAR TO good_repeat 
-                      AND lower(at1.track_name) SIMILAR TO bad_repeat 
+                      FROM album_titles AS at1 JOIN album_titles AS at2 ON 
+                      (at1.source_id, at1.album_uri, at1.title_stem) = (at2.source_id, at2.album_uri, at2.title_stem) 
+                      AND at1.track_num > at2.track_num 
+                      WHERE at1.bad_repeat AND NOT at1.good_repeat 
                
                       UNION SELECT source_id, album_uri, track_uri FROM tracks 
-                      JOIN sources USING (service_id) JOIN album_tracks USING (source_id, track_uri), regex_good_short, min_track_time 
-                      WHERE track_duration < min_seconds/60::numeric AND track_num > 1 
-                      AND lower(track_name) NOT SIMILAR TO good_short 
+                      JOIN sources USING (service_id) JOIN album_tracks USING (source_id, track_uri) 
+                      JOIN track_titles USING (service_id, track_uri), min_track_duration 
+                      WHERE track_duration < min_seconds/60::numeric AND track_num > 1 AND NOT good_short 
                       '''),
+              'depends': ['keywords', 'album_tracks', 'sources', 'tracks', 'track_titles'],
               },
              {'name': 'track_lists',
               'sql': ('''
                       WITH played_tracks AS 
-                      (SELECT source_id, album_uri, track_uri, ord 
-                      FROM albums, jsonb_array_elements_text(track_uris) WITH ORDINALITY AS elems(track_uri, ord) 
-                      EXCEPT SELECT source_id, album_uri, track_uri, 0 FROM auto_skips) 
+                      (SELECT source_id, album_uri, track_uri, track_num AS ord FROM album_tracks 
+                      WHERE (source_id, album_uri, track_uri) NOT IN (SELECT source_id, album_uri, track_uri FROM auto_skips)) 
                       
                       SELECT source_id, album_uri, jsonb_agg(track_uri ORDER BY ord) AS track_list, 
                       SUM(track_duration) AS play_duration 
                       FROM played_tracks JOIN sources USING (source_id) JOIN tracks USING (service_id, track_uri) 
                       GROUP BY source_id, album_uri 
                       '''),
+              'depends': ['album_tracks', 'auto_skips', 'sources', 'tracks'],
               },
              {'name': 'true_album_artists',
               'sql': ('''
                       WITH all_artists AS 
-                      (SELECT source_id, album_uri, primary_artist_uri, ord, 
-                      jsonb_array_length(track_uris) AS num_tracks 
-                      FROM albums JOIN sources USING (source_id) 
-                      JOIN tracks ON tracks.service_id = sources.service_id AND albums.track_uris ? tracks.track_uri, 
+                      (SELECT source_id, album_uri, primary_artist_uri, ord 
+                      FROM album_tracks JOIN sources USING (source_id) 
+                      JOIN tracks USING (service_id, track_uri), 
                       jsonb_array_elements_text(tracks.artist_uris) WITH ORDINALITY arr(primary_artist_uri, ord)), 
                       
                       counted_artists AS (SELECT source_id, album_uri, primary_artist_uri, COUNT(primary_artist_uri) AS freq 
-                      FROM all_artists WHERE ord <= 2 GROUP BY source_id, album_uri, primary_artist_uri),  # could drop the ord <= 2 requirement
+                      FROM all_artists WHERE ord <= 2 GROUP BY source_id, album_uri, primary_artist_uri), 
                       discounted_artists AS (SELECT source_id, album_uri, primary_artist_uri, freq/jsonb_array_length(track_uris)::numeric AS pct 
                       FROM counted_artists JOIN albums USING (source_id, album_uri)), 
                       
@@ -294,6 +457,7 @@ class SQLer:
                       JOIN sources USING (source_id) JOIN services USING (service_id) 
                       WHERE NOT artist_uris @> primary_artist_uris 
                       '''),
+              'depends': ['albums', 'album_tracks', 'sources', 'services', 'tracks'],
               },
              {'name': 'album_artists',
               'sql': ('''
@@ -306,30 +470,15 @@ class SQLer:
                       JOIN sources USING (source_id) JOIN artists USING (service_id, artist_uri) 
                       GROUP BY source_id, album_uri 
                       '''),
+              'depends': ['albums', 'true_album_artists', 'sources', 'artists'],
               },
              {'name': 'release_battles',
               'sql': ('''
-                      WITH battles AS 
-                      (SELECT user_id, source_id, album_uri, 
-                      CASE WHEN wins IS NULL THEN 0.0 
-                      WHEN losses IS NULL THEN 1.0 
-                      ELSE (jsonb_array_length(wins) / jsonb_array_length(wins || losses))::numeric END AS win_rate, 
-                      jsonb_array_length(COALESCE(wins, '[]')) + jsonb_array_length(COALESCE(losses, '[]')) AS n_games 
-                      FROM ownerships WHERE NOT (wins IS NULL AND losses IS NULL)), 
-                      
-                      coeff AS (SELECT 1.96 AS z), 
-                      
-                      wilson AS 
-                      (SELECT user_id, source_id, album_uri, 
-                      ((win_rate + (z ^ 2) / (2 * n_games) - z 
-                      * sqrt((win_rate * (1 - win_rate) + (z ^ 2) / (4 * n_games)) / n_games)) 
-                      / (1 + (z ^ 2) / n_games)) AS score 
-                      FROM battles, coeff) 
-                      
-                      SELECT user_id, source_id, album_uri, 
+                      SELECT user_id, source_id, album_uri, score, confidence, 
                       RANK() OVER(PARTITION BY user_id, category ORDER BY score DESC) AS ranking 
-                      FROM wilson JOIN album_categories USING (source_id, album_uri) 
+                      FROM album_ratings 
                       '''),
+              'depends': ['album_ratings'],
               },
              {'name': 'critic_stars',
               'sql': ('''
@@ -350,61 +499,56 @@ class SQLer:
                       round((percent_rank() OVER (ORDER BY points) * (max_stars - 1)) + 1)  AS stars 
                       FROM total_points, star_size
                       '''),
+              'depends': ['critics', 'keywords'],
               },
              {'name': 'chart_peaks',
               'sql': ('''
-                      SELECT source_id, album_uri, peak_position FROM albums JOIN album_artists USING (source_id, album_uri) 
-                      JOIN billboard ON 
-                      (CASE WHEN album_artists.artist_names ~* '\s+(and|&|/)\s+' 
-                      THEN regexp_replace(regexp_replace(lower(album_artists.artist_names), 
-                      '\s+&\s+|\s+and\s+|\s+/\s+', '; ', 'g'), ',\s*', '; ', 'g') 
-                      ELSE album_artists.artist_names END, 
-                      regexp_replace(lower(albums.album_name), '\s+/\s+', '/', 'g')) 
-                      = (CASE WHEN billboard.credit_names ~* '\s+(and|&|/)\s+' 
-                      THEN regexp_replace(regexp_replace(lower(billboard.credit_names), 
-                      '\s+&\s+|\s+and\s+|\s+/\s+', '; ', 'g'), ',\s*', '; ', 'g') 
-                      ELSE billboard.credit_names END, 
-                      regexp_replace(lower(billboard.album_title), '\s+/\s+', '/', 'g')) 
+                      SELECT source_id, album_uri, MIN(peak_position) AS peak_position 
+                      FROM album_match_keys JOIN billboard USING (title_key, artist_key) 
+                      GROUP BY source_id, album_uri 
                       '''),
+              'depends': ['album_match_keys', 'billboard'],
               },
              {'name': 'album_stars',
               'sql': ('''
-                      WITH critics_stars_expanded AS 
-                      (SELECT album_name, jsonb_array_elements_text(artist_names) AS artist_name, 
-                      stars FROM critic_stars) 
-                      
-                      SELECT source_id, album_uri, MIN(stars) AS stars FROM albums 
-                      JOIN album_artists USING (source_id, album_uri) 
-                      JOIN critics_stars_expanded ON critics_stars_expanded.album_name = albums.album_name 
-                      AND LOWER(album_artists.artist_names) ILIKE '%' || artist_name || '%' 
+                      SELECT source_id, album_uri, MIN(stars) AS stars FROM critic_matches 
+                      JOIN critics USING (critic_name, list_year, list_position) 
+                      JOIN critic_stars USING (album_name, artist_names) 
                       GROUP BY source_id, album_uri 
                       '''),
+              'depends': ['critic_matches', 'critics', 'critic_stars'],
               },
             ]
     
     updates = [{'name': 'update_tracks',
                 'sql': ('''
-                        SELECT service_id, jsonb_array_elements_text(track_uris) AS track_uri FROM albums 
+                        SELECT service_id, track_uri FROM album_tracks 
                         JOIN sources USING (source_id) 
                         EXCEPT SELECT service_id, track_uri FROM tracks WHERE 
                         track_name IS NOT NULL AND 
                         (explicit IS NOT NULL OR service_id NOT IN (SELECT service_id FROM services WHERE explicits)) 
                         '''),
+                'depends': ['album_tracks', 'sources', 'tracks', 'services'],
+                'keys': ['service_id', 'track_uri'],
                 },
                {'name': 'update_recordings',
                 'sql': ('''
-                        SELECT isrc FROM albums JOIN sources USING (source_id) 
-                        JOIN tracks ON sources.service_id = tracks.service_id AND albums.track_uris ? tracks.track_uri 
+                        SELECT isrc FROM album_tracks JOIN albums USING (source_id, album_uri) 
+                        JOIN sources USING (source_id) JOIN tracks USING (service_id, track_uri) 
                         LEFT JOIN barcodes USING (upc) 
                         WHERE album_type = 'compilation' OR release_type = 'compilation'
                         EXCEPT SELECT isrc FROM recordings 
                         '''),
+                'depends': ['album_tracks', 'albums', 'sources', 'tracks', 'barcodes', 'recordings'],
+                'keys': ['isrc'],
                 },
                {'name': 'update_works',
                 'sql': ('''
                         SELECT iswc FROM recordings WHERE iswc IS NOT NULL 
                         EXCEPT SELECT iswc FROM works 
                         '''),
+                'depends': ['recordings', 'works'],
+                'keys': ['iswc'],
                 },
                {'name': 'update_artists',
                 'sql': ('''
@@ -413,18 +557,20 @@ class SQLer:
                         JOIN sources USING (source_id) 
                         EXCEPT SELECT service_id, artist_uri FROM artists WHERE artist_name IS NOT NULL 
                         '''),
+                'depends': ['tracks', 'albums', 'sources', 'artists'],
+                'keys': ['service_id', 'artist_uri'],
                 },
                {'name': 'update_soundtracks',
                 'sql': ('''
-                        SELECT service_id, track_uri FROM tracks 
+                        SELECT DISTINCT service_id, track_uri FROM tracks 
                         JOIN sources USING (service_id) 
-                        JOIN albums ON sources.source_id = albums.source_id AND albums.track_uris ? tracks.track_uri 
-                        JOIN album_categories ON albums.source_id = album_categories.source_id 
-                        AND albums.album_uri = album_categories.album_uri 
-                        LEFT JOIN barcodes USING (upc) 
+                        JOIN album_tracks USING (source_id, track_uri) 
+                        JOIN album_categories USING (source_id, album_uri) 
                         WHERE album_categories.category = 'soundtrack' AND instrumentalness IS NULL 
                         AND service_id IN (SELECT service_id FROM services WHERE audio_analysis) 
                         '''),
+                'depends': ['tracks', 'sources', 'album_tracks', 'album_categories', 'services'],
+                'keys': ['service_id', 'track_uri'],
                 },
                {'name': 'update_upcs',
                 'sql': ('''
@@ -432,6 +578,8 @@ class SQLer:
                         FROM albums JOIN album_artists USING (source_id, album_uri) 
                         WHERE upc IS NULL OR upc = 'false' AND album_type NOT IN ('single', 'playlist') 
                         '''),
+                'depends': ['albums', 'album_artists'],
+                'keys': ['source_id', 'album_uri'],
                 },
                {'name': 'update_barcodes',
                 'sql': ('''
@@ -447,6 +595,8 @@ class SQLer:
                         JOIN albums USING (upc) JOIN sources USING (source_id) 
                         JOIN album_artists USING (source_id, album_uri) 
                         '''),
+                'depends': ['keywords', 'albums', 'barcodes', 'sources', 'album_artists'],
+                'keys': ['upc'],
                 },
                {'name': 'update_lastfm',
                 'sql': ('''
@@ -461,58 +611,102 @@ class SQLer:
                         SELECT source_id, album_uri, album_name, artist_names
                         FROM non_analytics JOIN albums USING (source_id, album_uri)
                         JOIN album_artists USING (source_id, album_uri)
-                        ''')}
+                        '''),
+                'depends': ['albums', 'sources', 'services', 'barcodes', 'lastfm', 'album_artists'],
+                },
               ]
     
-    oprhans = [{'name': '_orphan_albums',
+    orphans = [{'name': '_orphan_lastfm',
+                'table': 'lastfm',
+                'columns': ['source_id', 'album_uri'],
+                'sql': ('''
+                        SELECT source_id, album_uri FROM lastfm 
+                        WHERE NOT EXISTS (SELECT 1 FROM ownerships 
+                        WHERE ownerships.source_id = lastfm.source_id AND ownerships.album_uri = lastfm.album_uri) 
+                        '''),
+                'depends': ['lastfm', 'ownerships'],
+                },
+               {'name': '_orphan_albums',
+                'table': 'albums',
                 'columns': ['source_id', 'album_uri'],
                 'sql': ('''
                         SELECT source_id, album_uri FROM albums 
-                        EXCEPT SELECT source_id, album_uri FROM ownerships
+                        WHERE NOT EXISTS (SELECT 1 FROM ownerships 
+                        WHERE ownerships.source_id = albums.source_id AND ownerships.album_uri = albums.album_uri) 
+                        AND NOT EXISTS (SELECT 1 FROM replacements 
+                        WHERE (replacements.source_id = albums.source_id AND replacements.album_uri = albums.album_uri) 
+                        OR (replacements.replace_source_id = albums.source_id AND replacements.replace_album_uri = albums.album_uri)) 
                         '''),
+                'depends': ['albums', 'ownerships', 'replacements'],
                 },
                {'name': '_orphan_tracks',
+                'table': 'tracks',
                 'columns': ['service_id', 'track_uri'],
                 'sql': ('''
-                        SELECT service_id, track_uri FROM tracks
-                        EXCEPT
-                        SELECT service_id, jsonb_array_elements_text(track_uris) AS track_uri FROM albums
-                        JOIN sources USING (source_id)
+                        SELECT service_id, track_uri FROM tracks 
+                        WHERE NOT EXISTS (SELECT 1 FROM album_tracks JOIN sources USING (source_id) 
+                        WHERE sources.service_id = tracks.service_id AND album_tracks.track_uri = tracks.track_uri) 
                         '''),
+                'depends': ['tracks', 'album_tracks', 'sources'],
                 },
                {'name': '_orphan_artists',
+                'table': 'artists',
                 'columns': ['service_id', 'artist_uri'],
+                'refs': ('''
+                         SELECT service_id, jsonb_array_elements_text(artist_uris) AS artist_uri FROM tracks 
+                         UNION SELECT service_id, jsonb_array_elements_text(artist_uris) AS artist_uri FROM albums 
+                         JOIN sources USING (source_id) 
+                         '''),
                 'sql': ('''
-                        SELECT service_id, artist_uri FROM artists
-                        EXCEPT SELECT service_id, jsonb_array_elements_text(artist_uris) FROM tracks
-                        EXCEPT SELECT source_id, jsonb_array_elements_text(artist_uris) FROM albums
-                        JOIN sources USING (source_id)
+                        SELECT service_id, artist_uri FROM artists 
+                        WHERE NOT EXISTS (SELECT 1 FROM _orphan_refs 
+                        WHERE _orphan_refs.service_id = artists.service_id AND _orphan_refs.artist_uri = artists.artist_uri) 
                         '''),
+                'depends': ['artists', 'tracks', 'albums', 'sources'],
                 },
-               {'name': '_ophan_barcodes',
+               {'name': '_orphan_barcodes',
+                'table': 'barcodes',
                 'columns': ['upc'],
                 'sql': ('''
-                        SELECT upc FROM barcodes
-                        EXCEPT SELECT upc FROM albums
+                        SELECT upc FROM barcodes 
+                        WHERE NOT EXISTS (SELECT 1 FROM albums WHERE albums.upc = barcodes.upc) 
                         '''),
+                'depends': ['barcodes', 'albums'],
                 },
-               {'name': '_ophan_recordings',
+               {'name': '_orphan_recordings',
+                'table': 'recordings',
                 'columns': ['isrc'],
                 'sql': ('''
-                        SELECT isrc FROM recordings
-                        EXCEPT SELECT isrc FROM tracks
+                        SELECT isrc FROM recordings 
+                        WHERE NOT EXISTS (SELECT 1 FROM tracks WHERE tracks.isrc = recordings.isrc) 
                         '''),
+                'depends': ['recordings', 'tracks'],
                 },
-               {'name': '_ophan_works',
+               {'name': '_orphan_works',
+                'table': 'works',
                 'columns': ['iswc'],
                 'sql': ('''
-                        SELECT iswc FROM works
-                        EXCEPT SELECT iswc FROM recordings
+                        SELECT iswc FROM works 
+                        WHERE NOT EXISTS (SELECT 1 FROM recordings WHERE recordings.iswc = works.iswc) 
                         '''),
+                'depends': ['works', 'recordings'],
                 },
                ]
      
-    materialized = [{'name': 'user_albums',
+    materialized = [{'name': 'album_match_keys',
+                     'sql': ('''
+                             SELECT source_id, album_uri, 
+                             match_artists(array_to_string(ARRAY(SELECT jsonb_array_elements_text(artist_names)), '; ')) AS artist_key, 
+                             match_title(album_name) AS title_key 
+                             FROM albums JOIN album_artists USING (source_id, album_uri) 
+                             '''),
+                     'depends': ['albums', 'album_artists'],
+                     'keys': ['source_id', 'album_uri'],
+                     'columns': ['artist_key', 'title_key'],
+                     'indexes': [['title_key', 'artist_key']],
+                     'scope': 'none',
+                     },
+                    {'name': 'user_albums',
                      'sql': ('''
                              SELECT first_name || ' ' || last_name AS user_name, 
                              artist_names, album_name, category, 
@@ -531,6 +725,52 @@ class SQLer:
                              LEFT JOIN album_stars USING (source_id, album_uri) 
                              WHERE jsonb_array_length(track_list) > 0
                              '''),
+                     'depends': ['ownerships', 'sources', 'profiles', 'services', 'albums', 'album_artists', 'album_categories',
+                                 'release_battles', 'track_lists', 'explicit_albums', 'compilations', 'chart_peaks', 'album_stars'],
+                     'keys': ['user_id', 'source_id', 'album_uri'],
+                     'columns': ['user_name', 'artist_names', 'album_name', 'category', 'release_date', 'release_decades',
+                                 'ranking', 'rating', 'peak_position', 'stars', 'track_list', 'play_duration', 'explicit',
+                                 'service_name', 'source_name', 'service_id'],
+                     },
+                    {'name': 'album_candidates',
+                     'sql': ('''
+                             SELECT user_id, category, source_id, album_uri, 
+                             (ROW_NUMBER() OVER(PARTITION BY user_id, category ORDER BY source_id, album_uri) - 1)::integer AS ordinal 
+                             FROM ownerships JOIN album_categories USING (source_id, album_uri) 
+                             '''),
+                     'depends': ['ownerships', 'album_categories'],
+                     'keys': ['user_id', 'source_id', 'album_uri'],
+                     'columns': ['category', 'ordinal'],
+                     'indexes': [['user_id', 'category', 'ordinal']],
+                     'scope': 'user',
+                     },
+                    {'name': 'album_pools',
+                     'sql': ('''
+                             SELECT user_id, category, count(*) AS num_albums 
+                             FROM ownerships JOIN album_categories USING (source_id, album_uri) 
+                             GROUP BY user_id, category 
+                             '''),
+                     'depends': ['ownerships', 'album_categories'],
+                     'keys': ['user_id', 'category'],
+                     'columns': ['num_albums'],
+                     'scope': 'user',
+                     },
+                    {'name': 'album_summaries',
+                     'sql': (f'''
+                             SELECT user_id, ranks.category, source_id, album_uri, 
+                             user_albums.artist_names, user_albums.album_name, ranks.ranking, ownerships.rating 
+                             FROM (SELECT user_id, category, source_id, album_uri, 
+                             RANK() OVER(PARTITION BY user_id, category ORDER BY score DESC) AS ranking 
+                             FROM album_ratings) AS ranks 
+                             JOIN ownerships USING (user_id, source_id, album_uri) 
+                             LEFT JOIN user_albums USING (user_id, source_id, album_uri) 
+                             WHERE ranks.ranking <= {NEON_SUMMARY_RANKS} 
+                             '''),
+                     'depends': ['album_ratings', 'ownerships', 'user_albums'],
+                     'keys': ['user_id', 'source_id', 'album_uri'],
+                     'columns': ['category', 'artist_names', 'album_name', 'ranking', 'rating'],
+                     'indexes': [['user_id', 'category', 'ranking']],
+                     'scope': 'user',
                      },
                     ] 
     
@@ -538,50 +778,208 @@ class SQLer:
     
     ''' table setup '''
     def create_tables():
-        sqls = []
+        sqls = SQLer.create_functions()
         for table in SQLer.tables:
             sql = f'CREATE TABLE IF NOT EXISTS {table["name"]} ({table["sql"]});'
             sqls.append(sql)
+            sqls.extend(SQLer.create_indexes(table))
+        sqls.extend(SQLer.create_triggers())
         return sqls
-    
-    def drop_tables():
+
+    def create_functions():
         sqls = []
-        for table in SQLer.tables[::-1]:
-            sql = f'DROP TABLE IF EXISTS {table["name"]};'
+        for function in SQLer.functions:
+            sql = f'CREATE OR REPLACE FUNCTION {function["name"]} {function["sql"]};'
             sqls.append(sql)
         return sqls
 
-    ''' view setup '''                    
-    def create_views():
+    def create_triggers():
         sqls = []
-        for view in SQLer.views + SQLer.updates + SQLer.oprhans:
-            sql = f'CREATE OR REPLACE VIEW {view["name"]} AS {view["sql"]};'
+        for trigger in SQLer.triggers:
+            sql = f'CREATE OR REPLACE TRIGGER {trigger["name"]} {trigger["sql"]};'
             sqls.append(sql)
         return sqls
 
-    def materialize_views():
+    def create_indexes(table):
         sqls = []
-        for view in SQLer.materialized:
-            sql_1 = f'DROP MATERIALIZED VIEW IF EXISTS {view["name"]};'
-            sql_2 = f'CREATE MATERIALIZED VIEW {view["name"]} AS {view["sql"]};'
-            sqls.extend([sql_1, sql_2])
+        for columns in table.get('indexes', []):
+            index_name = '_'.join(c.split()[0] for c in columns)
+            sql = f'CREATE INDEX IF NOT EXISTS {table["name"]}_{index_name}_idx ON {table["name"]} ({", ".join(columns)});'
+            sqls.append(sql)
+        return sqls
+    
+    def drop_tables():
+        sqls = []
+        for table in SQLer.tables[::-1]:
+            sql = f'DROP TABLE IF EXISTS {table["name"]};'
+            sqls.append(sql)
         return sqls
 
-    def refresh_views():
+    ''' view setup '''                    
+    def materialize_view(view):
+        sql_1 = (f'''
+                 DO $$ BEGIN 
+                 IF EXISTS (SELECT 1 FROM pg_matviews WHERE matviewname = '{view["name"]}') 
+                 THEN DROP MATERIALIZED VIEW {view["name"]}; END IF; 
+                 END $$;
+                 ''')
+        sql_2 = f'DROP TABLE IF EXISTS {view["name"]};'
+        sql_3 = f'CREATE TABLE {view["name"]} AS SELECT *, now() AS refreshed_at FROM {view["name"]}_source;'
+        sql_4 = f'CREATE UNIQUE INDEX {view["name"]}_keys_idx ON {view["name"]} ({", ".join(view["keys"])});'
+        return [sql_1, sql_2, sql_3, sql_4] + SQLer.create_indexes(view)
+
+    def refresh_view(view, wheres=None):
+        # rewrite only the rows that differ from the definition, optionally limited to a scope
+        # the source is evaluated once into a staging table that both statements read
+        keys = view['keys']
+        columns = view['columns']
+        stage = f'_stage_{view["name"]}'
+        scope = f'({wheres}) AND ' if wheres else ''
+        matches = ' AND '.join(f'src.{k} = {view["name"]}.{k}' for k in keys)
+        sets = ', '.join(f'{c} = EXCLUDED.{c}' for c in columns)
+        olds = ', '.join(f'{view["name"]}.{c}' for c in columns)
+        news = ', '.join(f'EXCLUDED.{c}' for c in columns)
+        sql_0 = (f'''
+                 DROP TABLE IF EXISTS {stage}; 
+                 CREATE TEMP TABLE {stage} ON COMMIT DROP AS 
+                 SELECT {", ".join(keys + columns)} FROM {view["name"]}_source 
+                 {"WHERE " + wheres if wheres else ""} 
+                 ;
+                 ''')
+        sql_1 = (f'''
+                 DELETE FROM {view["name"]} WHERE {scope}NOT EXISTS 
+                 (SELECT 1 FROM {stage} AS src WHERE {matches}) 
+                 ;
+                 ''')
+        sql_2 = (f'''
+                 INSERT INTO {view["name"]} ({", ".join(keys + columns)}, refreshed_at) 
+                 SELECT {", ".join(keys + columns)}, now() FROM {stage} 
+                 ON CONFLICT ({", ".join(keys)}) DO UPDATE SET {sets}, refreshed_at = EXCLUDED.refreshed_at 
+                 WHERE ({olds}) IS DISTINCT FROM ({news}) 
+                 ;
+                 ''')
+        return [sql_0, f'ANALYZE {stage};', sql_1, sql_2]
+
+    def get_materialized(name):
+        return next(view for view in SQLer.materialized if view['name'] == name)
+
+    def refresh_views(scopes=None):
+        # scopes maps a view name to a WHERE clause, views not in scopes are refreshed in full
         sqls = []
         for view in SQLer.materialized:
-            sql = f'REFRESH MATERIALIZED VIEW {view["name"]};'
-            sqls.append(sql)
+            if (scopes is None) or (view['name'] not in scopes):
+                sqls.extend(SQLer.refresh_view(view))
+            elif scopes[view['name']]:
+                sqls.extend(SQLer.refresh_view(view, scopes[view['name']]))
         return sqls
 
+    def get_dependents(names):
+        # everything downstream of the given tables and views
+        objects = SQLer.get_objects()
+        dependents = set(names)
+        growing = True
+        while growing:
+            growing = False
+            for obj in objects:
+                if (obj['name'] not in dependents) and dependents.intersection(obj['depends']):
+                    dependents.add(obj['name'])
+                    growing = True
+        return dependents
+
+    def get_stale_views(tables):
+        dependents = SQLer.get_dependents(tables)
+        return [view['name'] for view in SQLer.materialized if view['name'] in dependents]
+
     def drop_views():
         sqls = []
-        for view in SQLer.views[::-1] + [SQLer.summary]:
-            sql = f'DROP VIEW IF EXISTS {view["name"]} CASCADE;'
+        names = [view['name'] for view in SQLer.views[::-1] + [SQLer.summary]]
+        for name in names:
+            sql = f'DROP VIEW IF EXISTS {name} CASCADE;'
             sqls.append(sql)
+        # forget every view the cascade reached so deploy_views creates them again
+        dependents = SQLer.get_dependents(names)
+        dropped = ', '.join(f"'{obj['name']}'" for obj in SQLer.get_objects() if (obj['kind'] == 'view') and (obj['name'] in dependents))
+        sql = (f'''
+               DO $$ BEGIN 
+               IF to_regclass('_schema_objects') IS NOT NULL 
+               THEN DELETE FROM _schema_objects WHERE object_name IN ({dropped}); END IF; 
+               END $$;
+               ''')
+        sqls.append(sql)
         return sqls
                
-    def summarize_views():
-        unions = ' UNION '.join(f"SELECT '{uv['name']}' AS update_name, count(*) AS remaining_rows FROM {uv['name']} " for uv in SQLer.updates) 
-        sql = f'CREATE OR REPLACE VIEW {SQLer.summary["name"]} AS {unions};'
-        return [sql]
\ No newline at end of file
+    def get_summary_sql():
+        # read the counts the queue triggers keep instead of evaluating every update view, parked items aren't remaining
+        names = ', '.join(f"('{uv['name']}')" for uv in SQLer.updates if 'keys' in uv)
+        counts = (f'''
+                  SELECT update_name, COALESCE(sum(queued_rows), 0) AS remaining_rows, max(counted_at) AS counted_at 
+                  FROM (VALUES {names}) AS updates(update_name) 
+                  LEFT JOIN _queue_counts ON 'update_' || queue_name = update_name AND failures < {NEON_QUEUE_MAX_FAILURES} 
+                  GROUP BY update_name 
+                  ''')
+        return counts
+
+    def get_orphan_sql(orphan):
+        # the referenced keys are read as _orphan_refs, a CTE in the view or a table staged once per cleanup
+        refs = f'WITH _orphan_refs AS ({orphan["refs"]}) ' if 'refs' in orphan else ''
+        return refs + orphan['sql']
+
+    ''' schema deploys '''
+    def get_objects():
+        # every object the database is built from, with what it reads
+        objects = [{'name': table['name'], 'kind': 'table', 'depends': [],
+                    'sql': table['sql'] + str(table.get('indexes', []))} for table in SQLer.tables]
+        objects += [{'name': view['name'], 'kind': 'view', 'depends': view['depends'],
+                     'sql': view['sql']} for view in SQLer.views + SQLer.updates]
+        objects += [{'name': orphan['name'], 'kind': 'view', 'depends': orphan['depends'],
+                     'sql': SQLer.get_orphan_sql(orphan)} for orphan in SQLer.orphans]
+        objects.append({'name': SQLer.summary['name'], 'kind': 'view', 'depends': ['_queue_counts'],
+                        'sql': SQLer.get_summary_sql()})
+        for view in SQLer.materialized:
+            objects.append({'name': f'{view["name"]}_source', 'kind': 'view', 'depends': view['depends'],
+                            'sql': view['sql']})
+            objects.append({'name': view['name'], 'kind': 'materialized', 'depends': [f'{view["name"]}_source'],
+                            'sql': view['sql'] + str(view['keys'] + view['columns'] + view.get('indexes', []))})
+        return objects
+
+    def fingerprint(obj):
+        definition = obj['kind'] + ' ' + ' '.join(obj['sql'].split())
+        return sha256(definition.encode()).hexdigest()[:16]
+
+    def sort_objects(objects):
+        # dependencies before dependents
+        names = {obj['name'] for obj in objects}
+        ordered = []
+        placed = set()
+        while len(ordered) < len(objects):
+            ready = [obj for obj in objects if (obj['name'] not in placed) and (names.intersection(obj['depends']) <= placed)]
+            if not ready:
+                raise ValueError(f'circular dependencies among {names - placed}')
+            ordered.extend(ready)
+            placed.update(obj['name'] for obj in ready)
+        return ordered
+
+    def deploy_objects(objects, rebuilds):
+        # objects must be sorted, views are dropped from the top down and created from the bottom up
+        sqls = []
+        for obj in objects[::-1]:
+            if obj['kind'] == 'view':
+                sqls.append(f'DROP VIEW IF EXISTS {obj["name"]} CASCADE;')
+        for obj in objects:
+            match obj['kind']:
+                case 'view':
+                    sqls.append(f'CREATE VIEW {obj["name"]} AS {obj["sql"]};')
+                case 'materialized' if obj['name'] in rebuilds:
+                    view = next(v for v in SQLer.materialized if v['name'] == obj['name'])
+                    sqls.extend(SQLer.materialize_view(view))
+        return sqls
+
+    def record_fingerprints(objects):
+        values = ', '.join(f"('{obj['name']}', '{obj['kind']}', '{SQLer.fingerprint(obj)}')" for obj in objects)
+        sql = (f'''
+               INSERT INTO _schema_objects (object_name, object_kind, fingerprint) VALUES {values} 
+               ON CONFLICT (object_name) DO UPDATE SET object_kind = EXCLUDED.object_kind, 
+               fingerprint = EXCLUDED.fingerprint, deployed_at = now() 
+               ;
+               ''')
+        return [sql] if objects else []
\ No newline at end of file
@@ -1,10 +1,17 @@
 ﻿''' Music fans '''
 
+import time
+
+from numpy import where, sqrt, maximum, nan_to_num, flatnonzero
 from pandas import isna
 
 from ..common.words import Texter, Colors
 from ..common.entry import Stroker
 from ..library.wordbank import RemoveWords
+from ..common.sampling import AliasTable
+from ..data.queues import Prefetcher, WriteBehind
+from ..data.snapshots import Snapshot
+from ..data.replicas import Replica
 
 class User:
     def __init__(self, user_id, first_name, last_name):
@@ -68,6 +75,9 @@ class Ranker(Texter, Picker):
         
         print(f'Welcome {user_name}!')
         
+        # results are written in the background while the next albums are already waiting
+        self.writer = WriteBehind(neon)
+        
         loop = True
         while loop:
             print(f'What would you like to do: {Colors.BLUE}[1]{Colors.END} rank albums, '
@@ -84,9 +94,13 @@ class Ranker(Texter, Picker):
                         self.rate_albums(neon, user_id)
                 
             if key in ['1', '2', '3']:
+                self.writer.close()
                 self.get_summary(neon, user_id)
+                self.writer = WriteBehind(neon)
+
+        self.writer.close()
 
-        # make sure to update results in the materialized views
+        # make sure to update results in the materialized views, only for what changed
         print('refreshing materialized view')
         neon.refresh_views()
         print(f'See you later, {user_name}!')
@@ -101,12 +115,13 @@ class Ranker(Texter, Picker):
             _, _ = Stroker.get_keystroke()
             
     def rank_albums(self, neon, user_id):
+        pairs = Prefetcher(lambda: neon.get_album_comparisons(user_id))
         loop = True
         while loop:
             # get albums to rank
             print('...pulling up albums to compare...\n')
-            albums_df = neon.get_album_comparisons(user_id)
-            if not albums_df.empty:
+            albums_df = pairs.get()
+            if (albums_df is not None) and (len(albums_df) == 2):
                 # user has albums to compare in this category
                 artist_names_a, album_name_a, ranking_a = albums_df.iloc[0][['artist_names', 'album_name','ranking']]
                 artist_names_b, album_name_b, ranking_b = albums_df.iloc[1][['artist_names', 'album_name', 'ranking']]
@@ -131,18 +146,22 @@ class Ranker(Texter, Picker):
                     print('...updating ranks...')
                     source_id_1, album_uri_1 = albums_df.loc[0][['source_id', 'album_uri']]
                     source_id_2, album_uri_2 = albums_df.loc[1][['source_id', 'album_uri']]
-                    neon.update_album_comparisons(user_id, source_id_1, album_uri_1, source_id_2, album_uri_2, int(key))
+                    self.writer.put(neon.get_album_comparison_sqls(user_id, source_id_1, album_uri_1, source_id_2, album_uri_2,
+                                                                   int(key), category=category))
                                        
             else:
                 loop = False
+        pairs.stop()
                
     def rate_albums(self, neon, user_id):
+        albums = Prefetcher(lambda: neon.get_album_to_rate(user_id, unrated=True), key=lambda album_s: album_s['album_uri'])
         loop = True
         while loop:
             # get albums to rank
             print('...pulling up album to rate...\n')
-            album_s = neon.get_album_to_rate(user_id, unrated=True)
-            loop = self.rate_album(neon, user_id, album_s)
+            album_s = albums.get()
+            loop = (album_s is not None) and (not album_s.empty) and self.rate_album(neon, user_id, album_s)
+        albums.stop()
         
     def rate_album(self, neon, user_id, album_s):
         source_id, album_uri, album_name, artist_names, rating = album_s[['source_id', 'album_uri',
@@ -165,17 +184,85 @@ class Ranker(Texter, Picker):
         if loop and (key not in ['ENTER', current_rating]):
             rating = ratings.index(key) + 1
             print(f'...updating rating to {rating}...')
-            neon.update_album_rating(user_id, source_id, album_uri, rating)
+            self.writer.put(neon.get_album_rating_sqls(user_id, source_id, album_uri, rating))
 
         return loop
 
 
+class Shuffler:
+    half_life = 7 # days until a played album is back to half its weight
+    max_tries = 50
+
+    def __init__(self, replica, user_id, **filters):
+        self.replica = replica
+        self.user_id = user_id
+        self.filters = filters
+        self.snapshot = None
+        self.indices = None
+        self.keys = None
+        self.alias_table = None
+        self.last_played = {}
+
+    def get_weights(self, snapshot):
+        # favor higher ratings, rankings, critic stars and chart peaks, with missing values left neutral
+        rating = 0.5 + where(snapshot.rating >= 0, snapshot.rating, 5) / 10
+        ranking = where(snapshot.ranking < snapshot.missing_rank, 1 + 1 / sqrt(maximum(snapshot.ranking, 1)), 1)
+        stars = 1 + nan_to_num(snapshot.stars) / 5
+        peak = where(snapshot.peak_position < snapshot.missing_rank, 1 + 1 / sqrt(maximum(snapshot.peak_position, 1)), 1)
+        return (rating * ranking * stars * peak)[self.indices].tolist()
+
+    def refresh(self, snapshot):
+        # rebuild the alias table only when a new snapshot has been loaded
+        if snapshot is not self.snapshot:
+            self.indices = flatnonzero(snapshot.get_mask(**self.filters))
+            self.keys = [tuple(k) for k in snapshot.albums_df.iloc[self.indices][['source_id', 'album_uri']].values]
+            self.alias_table = AliasTable(self.get_weights(snapshot))
+            self.last_played = self.replica.get_last_played(self.user_id)
+            self.snapshot = snapshot
+
+    def get_recency(self, i):
+        last_played = self.last_played.get(self.keys[i])
+        if last_played is None:
+            return 1
+        days = (time.time() - last_played) / 86400
+        return 1 - 0.5 ** (max(days, 0) / self.half_life)
+
+    def draw(self):
+        # recent plays are turned away instead of rebuilding the table after every play
+        i = None
+        for _ in range(self.max_tries):
+            i = self.alias_table.draw()
+            if (i is None) or (self.alias_table.rng.random() < self.get_recency(i)):
+                break
+        return i
+
+    def get_queue(self, snapshot, n):
+        self.refresh(snapshot)
+        queue = []
+        for _ in range(n):
+            i = self.draw()
+            if i is None:
+                break
+            self.last_played[self.keys[i]] = time.time()
+            queue.append(snapshot.get_album(self.indices[i]))
+        return queue
+
+    def get_album(self, snapshot):
+        queue = self.get_queue(snapshot, 1)
+        return queue[0] if queue else None
+
+
 class Turntable(Picker):
-    def __init__(self):
+    def __init__(self, shuffle=False, **filters):
         super().__init__()
         self.users = []
         self.record_stack = []
         self.needle = -1
+        self.shuffle = shuffle
+        self.shuffler = None
+        self.filters = filters
+        self.snapshot = None
+        self.replica = None
         
     def play_music(self, neon, sonoser):
         
@@ -184,6 +271,10 @@ class Turntable(Picker):
         user_name = user.first_name + ' ' + user.last_name
         user_id = user.user_id
         print(f'Welcome {user_name}!')
+        # filter and pick from memory, loaded from the local replica when there is one
+        self.load_snapshot(neon, user_id)
+        if self.shuffle:
+            self.shuffler = Shuffler(self.replica, user_id, **self.filters)
         press_right = '[→] to play the next album'
         
         loop = True
@@ -215,13 +306,38 @@ class Turntable(Picker):
 
                 elif key == 'DOWN':
                     sonoser.change_play_status()
+
+        # plays are kept locally while listening and sent when leaving
+        try:
+            self.replica.sync_plays(neon, user_id)
+        except Exception as e:
+            print(f'...plays will be sent next time, sync failed due to {e}.')
                 
+    def load_snapshot(self, neon, user_id):
+        replica = self.replica = Replica()
+        if replica.has_albums(user_id):
+            self.snapshot = Snapshot(replica, user_id)
+            replica.sync_in_background(neon, user_id, on_done=lambda: setattr(self, 'snapshot', Snapshot(replica, user_id)))
+        else:
+            try:
+                replica.sync(neon, user_id)
+                self.snapshot = Snapshot(replica, user_id)
+            except Exception as e:
+                print(f'...replica sync failed due to {e}.')
+                self.snapshot = Snapshot(neon, user_id)
+
     def select_album(self, neon, user_id, skip=0):
         # get the next album to play
         self.needle += skip
         if self.needle >= len(self.record_stack):
             # add new album to the stack
-            self.record_stack.append(neon.get_random_album(user_id))
+            album_s = self.shuffler.get_album(self.snapshot) if self.shuffler else self.snapshot.get_random_album(**self.filters)
+            if album_s is None:
+                # fall back to the database for anything the replica doesn't have
+                album_s = neon.get_random_album(user_id, **self.filters)
+            self.record_stack.append(album_s)
+            if (album_s is not None) and (not album_s.empty):
+                self.replica.record_play(user_id, album_s['source_id'], album_s['album_uri'])
         album_s = self.record_stack[self.needle]
         return album_s
         
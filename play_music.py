@@ -14,9 +14,9 @@ def set_up_speakers():
    
     return sonoser
 
-def play_albums(neon, sonoser):
+def play_albums(neon, sonoser, shuffle=False):
     users = set_up_users(neon)
-    turntable = Turntable()
+    turntable = Turntable(shuffle=shuffle)
     turntable.add_users(users)
     turntable.play_music(neon, sonoser)
     
@@ -9,9 +9,10 @@ def update_recordings(neon):
     if is_updatable(tracks_df):
         service = MusicBrainer()        
         service.connect()
-        tracks_df = service.get_recordings_data(tracks_df)
-        if is_updatable(tracks_df):
-            neon.update_recordings(tracks_df)
+        updates_df = service.get_recordings_data(tracks_df)
+        if is_updatable(updates_df):
+            neon.update_recordings(updates_df)
+        neon.release_queue('recordings', tracks_df, updates_df)
         service.disconnect()
         
 def update_works(neon):
@@ -20,9 +21,10 @@ def update_works(neon):
     if is_updatable(tracks_df):
         service = MusicBrainer()        
         service.connect()
-        tracks_df = service.get_works_data(tracks_df)
-        if is_updatable(tracks_df):
-            neon.update_works(tracks_df)
+        updates_df = service.get_works_data(tracks_df)
+        if is_updatable(updates_df):
+            neon.update_works(updates_df)
+        neon.release_queue('works', tracks_df, updates_df)
         service.disconnect()
 
 def update_barcodes(neon):
@@ -30,18 +32,20 @@ def update_barcodes(neon):
     if is_updatable(albums_df):
         service = MusicBrainer()
         service.connect()
-        albums_df = service.find_barcodes_data(albums_df)
-        if is_updatable(albums_df):
-            neon.update_upcs(albums_df)
+        updates_df = service.find_barcodes_data(albums_df)
+        if is_updatable(updates_df):
+            neon.update_upcs(updates_df)
+        neon.release_queue('upcs', albums_df, updates_df)
         service.disconnect()
         
     albums_df = neon.get_barcodes_to_update()
     if is_updatable(albums_df):
         service = MusicBrainer()        
         service.connect()
-        albums_df = service.get_barcodes_data(albums_df)
-        if is_updatable(albums_df):
-            neon.update_barcodes(albums_df)    
+        updates_df = service.get_barcodes_data(albums_df)
+        if is_updatable(updates_df):
+            neon.update_barcodes(updates_df)    
+        neon.release_queue('barcodes', albums_df, updates_df)
         service.disconnect()
         
 def main():
@@ -10,9 +10,10 @@ def update_tracks(neon, DSPs):
         tracks_df = neon.get_tracks_to_update(service_id)
         if is_updatable(tracks_df):
             service.connect()
-            tracks_df = service.get_tracks_data(tracks_df)
-            if is_updatable(tracks_df):
-                neon.update_tracks(tracks_df, service_id)    
+            updates_df = service.get_tracks_data(tracks_df)
+            if is_updatable(updates_df):
+                neon.update_tracks(updates_df, service_id)    
+            neon.release_queue('tracks', tracks_df, updates_df)
             service.disconnect()
     
 def update_artists(neon, DSPs):
@@ -22,9 +23,10 @@ def update_artists(neon, DSPs):
         artists_df = neon.get_artists_to_update(service_id)
         if is_updatable(artists_df):
             service.connect()
-            artists_df = service.get_artists_data(artists_df)
-            if is_updatable(artists_df):
-                neon.update_artists(artists_df, service_id)    
+            updates_df = service.get_artists_data(artists_df)
+            if is_updatable(updates_df):
+                neon.update_artists(updates_df, service_id)    
+            neon.release_queue('artists', artists_df, updates_df)
             service.disconnect()
 
 def update_soundtracks(neon, DSPs):
@@ -34,9 +36,10 @@ def update_soundtracks(neon, DSPs):
         tracks_df = neon.get_soundtracks_to_update(service_id)
         if is_updatable(tracks_df):
             service.connect()
-            tracks_df = service.get_soundtracks_data(tracks_df)
-            if is_updatable(tracks_df):
-                neon.update_soundtracks(tracks_df, service_id)    
+            updates_df = service.get_soundtracks_data(tracks_df)
+            if is_updatable(updates_df):
+                neon.update_soundtracks(updates_df, service_id)    
+            neon.release_queue('soundtracks', tracks_df, updates_df)
             service.disconnect()
                 
 def main():
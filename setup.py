@@ -3,23 +3,26 @@
 from .data.database import Neon
 from .music.listeners import User
 
-def set_up_database(drop_tables=False, drop_views=False, create_tables=False, create_views=False, materialize=False):
+def set_up_database(drop_tables=False, drop_views=False, create_tables=False, create_views=False, materialize=False,
+                    deploy_views=False, keywords=False):
     neon = Neon()
     neon.connect()
     if drop_tables:
         neon.drop_tables()
-    # # if keywords:
-    # #     neon.create_keywords()
     # # if services:
     # #     neon.add_services()
     if create_tables:
         neon.create_tables()
+    if keywords:
+        neon.create_keywords()
     if drop_views:
         neon.drop_views()
     if create_views:
         neon.create_views()
     if materialize:
         neon.materialize_views()
+    if deploy_views:
+        neon.deploy_views()
     return neon
 
 def set_up_user(neon, user_id):
@@ -36,7 +39,7 @@ def is_updatable(df):
     return (df is not None) and (not df.dropna(how='all').empty)
 
 def main():
-    set_up_database(drop_tables=False, create_tables=True, drop_views=True, create_views=True, materialize=True)
+    set_up_database(create_tables=True, keywords=True, deploy_views=True)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
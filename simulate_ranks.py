@@ -0,0 +1,62 @@
+''' Compare pair strategies on synthetic libraries '''
+
+import random
+
+from pandas import DataFrame
+
+from .data.ratings import Elo, Pairer
+
+def get_correlation(scores, strengths):
+    # Spearman correlation between the rated order and the true order
+    num_albums = len(scores)
+    rank_scores = {i: r for r, i in enumerate(sorted(range(num_albums), key=lambda i: scores[i]))}
+    rank_strengths = {i: r for r, i in enumerate(sorted(range(num_albums), key=lambda i: strengths[i]))}
+    d_squared = sum((rank_scores[i] - rank_strengths[i]) ** 2 for i in range(num_albums))
+    return 1 - 6 * d_squared / (num_albums * (num_albums ** 2 - 1))
+
+def simulate_library(num_albums, strategy, rng, target=0.9, max_comparisons=None, spread=200):
+    # play simulated clicks until the ratings order is close enough to the hidden strengths
+    max_comparisons = max_comparisons or 50 * num_albums
+    strengths = [rng.gauss(Elo.base, spread) for _ in range(num_albums)]
+    scores = [Elo.base] * num_albums
+    games = [0] * num_albums
+    played = set()
+
+    for comparison in range(1, max_comparisons + 1):
+        first, second = Pairer.pick(scores, games, played, strategy=strategy, rng=rng)
+        won = int(rng.random() < Elo.get_expected(strengths[first], strengths[second]))
+        score_f, score_s = scores[first], scores[second]
+        scores[first] = Elo.get_update(score_f, score_s, won)
+        scores[second] = Elo.get_update(score_s, score_f, 1 - won)
+        games[first] += 1
+        games[second] += 1
+        played.add(frozenset([first, second]))
+
+        # checked after every click so the counts are not rounded to the library size
+        if get_correlation(scores, strengths) >= target:
+            return comparison, True
+
+    return max_comparisons, False
+
+def simulate(library_sizes=[20, 50, 100], trials=20, target=0.9, seed=0):
+    rng = random.Random(seed)
+    results = []
+    for num_albums in library_sizes:
+        for strategy in Pairer.strategies:
+            for trial in range(trials):
+                comparisons, converged = simulate_library(num_albums, strategy, rng, target=target)
+                results.append({'num_albums': num_albums, 'strategy': strategy, 'trial': trial,
+                                'comparisons': comparisons, 'converged': converged})
+
+    results_df = DataFrame(results)
+    summary_df = results_df.groupby(['num_albums', 'strategy']).agg(comparisons=('comparisons', 'median'),
+                                                                    converged=('converged', 'mean')).reset_index()
+    return summary_df
+
+def main():
+    summary_df = simulate()
+    print('Comparisons until the rated order reaches the target correlation:')
+    print(summary_df)
+
+if __name__ == '__main__':
+    main()